@@ -0,0 +1,187 @@
+import base64
+import sys
+import types
+
+"""
+appengine_stubs.py - Stand-ins for the App Engine SDK.
+
+benchmark.py and the tests run the game code outside App Engine, on a
+storage.MemoryRepository.  When the SDK is not installed, install() puts
+minimal stand-ins for ndb, protorpc, endpoints and the other modules the
+game code imports in sys.modules; call it before importing the game code:
+
+    import appengine_stubs
+    appengine_stubs.install()
+
+The stand-ins only support what the benchmarks and tests use.  In
+particular properties do not validate their values, so tests should only
+store entities that the datastore would accept.
+"""
+
+
+class _Property(object):
+    """Stand-in for ndb properties: plain attributes with defaults."""
+
+    def __init__(self, *args, **kwargs):
+        self._default = kwargs.get('default')
+        self._repeated = kwargs.get('repeated', False)
+        self._name = None
+
+    def __get__(self, entity, model):
+        if entity is None:
+            return self
+        if self._name not in entity.__dict__:
+            return [] if self._repeated else self._default
+        return entity.__dict__[self._name]
+
+    def __set__(self, entity, value):
+        entity.__dict__[self._name] = value
+
+
+class _ComputedProperty(_Property):
+
+    def __init__(self, function, *args, **kwargs):
+        super(_ComputedProperty, self).__init__()
+        self._function = function
+
+    def __get__(self, entity, model):
+        return self if entity is None else self._function(entity)
+
+
+class _ModelType(type):
+
+    def __init__(cls, name, bases, attrs):
+        super(_ModelType, cls).__init__(name, bases, attrs)
+        for attr, value in attrs.items():
+            if isinstance(value, _Property):
+                value._name = attr
+
+
+class _Model(object):
+    __metaclass__ = _ModelType
+
+    def __init__(self, key=None, **kwargs):
+        self.key = key
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+    @classmethod
+    def _get_kind(cls):
+        return cls.__name__
+
+
+class _Key(object):
+
+    def __init__(self, kind, id):
+        self._pair = (kind if isinstance(kind, str) else kind.__name__, id)
+
+    def kind(self):
+        return self._pair[0]
+
+    def id(self):
+        return self._pair[1]
+
+    def urlsafe(self):
+        return base64.urlsafe_b64encode(repr(self._pair))
+
+    def __eq__(self, other):
+        return isinstance(other, _Key) and self._pair == other._pair
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __lt__(self, other):
+        return self._pair < other._pair
+
+    def __hash__(self):
+        return hash(self._pair)
+
+
+class _EnumValue(object):
+
+    def __init__(self, name, number):
+        self.name = name
+        self.number = number
+
+    def __str__(self):
+        return self.name
+
+
+class _EnumType(type):
+
+    def __init__(cls, name, bases, attrs):
+        super(_EnumType, cls).__init__(name, bases, attrs)
+        cls._values = []
+        for attr, value in attrs.items():
+            if isinstance(value, int):
+                enum_value = _EnumValue(attr, value)
+                setattr(cls, attr, enum_value)
+                cls._values.append(enum_value)
+        cls._values.sort(key=lambda value: value.number)
+
+    def __iter__(cls):
+        return iter(cls._values)
+
+    def __call__(cls, number):
+        for value in cls._values:
+            if value.number == number:
+                return value
+        raise TypeError('No enum value {}'.format(number))
+
+
+class _Message(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+
+def install():
+    """Installs stand-ins for the App Engine modules the game code imports,
+    unless the SDK is importable.  Returns whether it did."""
+    try:
+        import google.appengine.ext.ndb  # noqa
+        import protorpc.messages  # noqa
+        return False
+    except ImportError:
+        pass
+
+    field = lambda *args, **kwargs: None
+    _module('protorpc', messages=_module(
+        'protorpc.messages',
+        Enum=_EnumType('Enum', (object,), {}), Message=_Message,
+        StringField=field, IntegerField=field, BooleanField=field,
+        FloatField=field, EnumField=field, MessageField=field))
+
+    class _Error(Exception):
+        pass
+
+    _module('endpoints', NotFoundException=_Error,
+            BadRequestException=_Error, ConflictException=_Error)
+
+    ndb = _module(
+        'google.appengine.ext.ndb', Model=_Model, Key=_Key,
+        BlobProperty=_Property, BooleanProperty=_Property,
+        DateProperty=_Property, FloatProperty=_Property,
+        IntegerProperty=_Property, KeyProperty=_Property,
+        StringProperty=_Property, ComputedProperty=_ComputedProperty,
+        in_transaction=lambda: False)
+    deferred = _module('google.appengine.ext.deferred')
+    api = _module('google.appengine.api', datastore_errors=_module(
+        'google.appengine.api.datastore_errors', BadValueError=_Error,
+        BadRequestError=_Error))
+    for name in ['app_identity', 'mail', 'memcache', 'taskqueue']:
+        setattr(api, name, _module('google.appengine.api.' + name))
+    datastore = _module('google.appengine.datastore', datastore_query=_module(
+        'google.appengine.datastore.datastore_query', Cursor=object))
+    ext = _module('google.appengine.ext', ndb=ndb, deferred=deferred)
+    appengine = _module('google.appengine', api=api, ext=ext,
+                        datastore=datastore)
+    _module('google', appengine=appengine)
+    return True
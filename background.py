@@ -0,0 +1,102 @@
+import logging
+import os
+import threading
+import Queue
+
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+
+import storage
+
+"""
+background.py - Work deferred until after the response.
+
+defer(function, *args, **kwargs) runs function(*args, **kwargs) later on
+the active queue:
+
+    AppEngineQueue   the App Engine deferred library (a push task queue);
+                     tasks deferred in a transaction are only queued if it
+                     commits
+    LocalQueue       a worker thread in this process, for the memory and
+                     SQLite storage backends
+
+Deferred functions must be module-level functions and must be safe to run
+more than once, since both queues retry a task that raises.  The queue is
+chosen with the YAHTZEE_TASKS environment variable ('appengine' or
+'local'); by default tasks run locally unless entities are stored in the
+datastore.
+"""
+
+MAX_ATTEMPTS = 3
+
+
+class AppEngineQueue(object):
+    """Queues tasks with the App Engine deferred library."""
+
+    def defer(self, function, *args, **kwargs):
+        deferred.defer(function, *args,
+                       _transactional=ndb.in_transaction(), **kwargs)
+
+
+class LocalQueue(object):
+    """Runs tasks one at a time on a worker thread."""
+
+    def __init__(self):
+        self._tasks = Queue.Queue()
+        self._worker = threading.Thread(target=self._run)
+        self._worker.daemon = True
+        self._worker.start()
+
+    def defer(self, function, *args, **kwargs):
+        self._tasks.put((function, args, kwargs))
+
+    def join(self):
+        """Waits until every task queued so far has run."""
+        self._tasks.join()
+
+    def _run(self):
+        while True:
+            function, args, kwargs = self._tasks.get()
+            for attempt in range(1, MAX_ATTEMPTS + 1):
+                try:
+                    function(*args, **kwargs)
+                    break
+                except Exception:
+                    logging.exception('Task %s failed (attempt %d of %d)',
+                                      function.__name__, attempt,
+                                      MAX_ATTEMPTS)
+            self._tasks.task_done()
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def _from_environment():
+    setting = os.environ.get('YAHTZEE_TASKS')
+    if setting is None:
+        setting = ('appengine' if isinstance(storage.get_repository(),
+                                             storage.NdbRepository)
+                   else 'local')
+    if setting == 'local':
+        return LocalQueue()
+    return AppEngineQueue()
+
+
+def get_queue():
+    """Returns the active queue."""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = _from_environment()
+    return _queue
+
+
+def set_queue(queue):
+    """Replaces the active queue."""
+    global _queue
+    _queue = queue
+
+
+def defer(function, *args, **kwargs):
+    get_queue().defer(function, *args, **kwargs)
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+
+import argparse
+import cPickle as pickle
+import gc
+import json
+import os
+import platform
+import sys
+import timeit
+
+import appengine_stubs
+
+"""
+benchmark.py - Microbenchmarks for the game logic.
+
+Times scoring, rolling, form serialization and the packed formats, and
+compares every result with benchmark_baseline.json:
+
+    python benchmark.py                    # fails if anything regressed
+    python benchmark.py --update-baseline  # records new baseline results
+
+Each result is the best of REPEATS runs, in microseconds per operation;
+the runs of each benchmark are interleaved with those of the others.  A
+result more than --threshold (default 25%) slower than its baseline is a
+regression, and the script then exits with status 1; results past the
+threshold are timed a second time first, so that a single noisy run does
+not fail.  The baseline of each benchmark is its median result over
+BASELINE_RUNS runs of the suite.  Baselines depend on the machine, so
+record them on the machine the comparison runs on.
+
+Load from elsewhere on a shared machine comes and goes over seconds, so
+the runs are many and short and each benchmark's are spread over the
+whole suite, which keeps its results within about a tenth of their
+median.  The default threshold leaves a margin over that; confirm smaller
+slowdowns by comparing several runs with --output.
+
+Entities are stored in a storage.MemoryRepository.  The game.score_roll
+benchmarks do not store the game, so they time the scoring itself;
+game.roll_dice and game.roll_again include the write, the entity cache
+update and reading the user's name.  When the App Engine SDK is not
+installed, the stand-ins in appengine_stubs.py are installed first.
+"""
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'benchmark_baseline.json')
+DEFAULT_THRESHOLD = 0.25
+REPEATS = 20
+BASELINE_RUNS = 5
+
+
+# Benchmarks
+
+DICE = [3, 3, 3, 5, 5]
+
+
+def _time(setup, run, number):
+    """Returns the time of number runs of run(state) over number states
+    returned by setup(), in microseconds per operation.  Setup is not
+    timed, and neither is garbage collection."""
+    states = [setup() for i in range(number)]
+    gc.disable()
+    try:
+        started = timeit.default_timer()
+        for state in states:
+            run(state)
+        elapsed = timeit.default_timer() - started
+    finally:
+        gc.enable()
+    return elapsed * 1e6 / number
+
+
+def _unsaved(run):
+    """Returns run with storage.put not storing anything, so that it times
+    the game logic rather than the repository and the entity cache, which
+    game.roll_dice and game.roll_again already cover."""
+    import storage
+
+    def unsaved(state):
+        put = storage.put
+        storage.put = lambda entity: None
+        try:
+            return run(state)
+        finally:
+            storage.put = put
+    return unsaved
+
+
+def _benchmarks():
+    """Returns a list of (name, setup, run, number)."""
+    import dice
+    import game_history
+    import scoresheet
+    import storage
+    from game import Game
+    from scorecard import CategoryType, Scorecard
+    from scoresheet import CategoryScores
+    from user import User
+
+    storage.set_repository(storage.MemoryRepository())
+    user = User(name='benchmark', email=None)
+    storage.put(user)
+
+    def new_game():
+        game = Game.new_game(user.key)
+        game.roll_dice()
+        game.dice = list(DICE)
+        return game
+
+    def played_game(turns):
+        """Returns a game with turns - 1 turns scored and the last rolled
+        twice."""
+        game = new_game()
+        for category in list(CategoryType)[:turns - 1]:
+            game.roll_again([1, 1, 0, 0, 0])
+            game.score_roll(category)
+            game.roll_dice()
+        game.roll_again([1, 1, 0, 0, 0])
+        return game
+
+    benchmarks = []
+    for category in CategoryType:
+        benchmarks.append(
+            ('game.score_roll.{}'.format(category.name), new_game,
+             _unsaved(lambda game, category=category:
+                      game.score_roll(category)),
+             50))
+
+    scorecard = Scorecard(category_scores=CategoryScores())
+    categories = list(CategoryType)
+    benchmarks.append(
+        ('scorecard.calculate_score_for_category', lambda: scorecard,
+         lambda card: [card.calculate_score_for_category(DICE, category)
+                       for category in categories], 500))
+
+    benchmarks.append(('game.roll_dice', lambda: Game.new_game(user.key),
+                       Game.roll_dice, 125))
+    benchmarks.append(('game.roll_again', new_game,
+                       lambda game: game.roll_again([1, 0, 1, 0, 1]), 125))
+    benchmarks.append(('dice.draw', lambda: dice.DiceStream(1),
+                       lambda stream: stream.draw(5), 5000))
+
+    turn_1 = played_game(1)
+    turn_13 = played_game(13)
+    benchmarks.append(('game.to_form.turn_1', lambda: turn_1,
+                       Game.to_form, 250))
+    benchmarks.append(('game.to_form.turn_13', lambda: turn_13,
+                       Game.to_form, 250))
+
+    history = turn_13.history
+    scores = turn_13.category_scores
+    packed_scores = scores.pack()
+    benchmarks.extend([
+        ('history.append', lambda: history,
+         lambda log: game_history.append(log, game_history.encode_roll(
+             13, 3, DICE)), 5000),
+        ('history.decode', lambda: history, game_history.decode, 500),
+        ('category_scores.pack', lambda: scores, CategoryScores.pack,
+         5000),
+        ('category_scores.unpack', lambda: packed_scores,
+         CategoryScores.unpack, 5000),
+        ('dice.pack', lambda: DICE, scoresheet.pack_dice, 5000),
+        ('game.pickle', lambda: turn_13,
+         lambda game: pickle.dumps(game, pickle.HIGHEST_PROTOCOL), 500),
+    ])
+    return benchmarks
+
+
+def run_benchmarks(names=None, name_filter=None, repeats=REPEATS):
+    """Returns a dict of benchmark name to its best time of repeats, in
+    microseconds per operation, for the benchmarks named in names (default
+    all) whose names contain name_filter.
+
+    Each repeat times every benchmark once, so that the runs of any one
+    benchmark are spread over the whole suite and a few seconds of load
+    from elsewhere on the machine slow only some of them."""
+    benchmarks = [(name, setup, run, number)
+                  for name, setup, run, number in _benchmarks()
+                  if (names is None or name in names) and
+                  (not name_filter or name_filter in name)]
+    results = {}
+    for repeat in range(repeats):
+        for name, setup, run, number in benchmarks:
+            elapsed = _time(setup, run, number)
+            results[name] = min(results.get(name, elapsed), elapsed)
+    return results
+
+
+def median_results(runs):
+    """Returns the median result of each benchmark in a list of results."""
+    medians = {}
+    for name in runs[0]:
+        values = sorted(results[name] for results in runs)
+        middle = len(values) // 2
+        medians[name] = (values[middle] if len(values) % 2 else
+                         (values[middle - 1] + values[middle]) / 2)
+    return medians
+
+
+def regressions(results, baseline, threshold):
+    """Returns (name, result, baseline result) for each result more than
+    threshold slower than its baseline."""
+    return [(name, results[name], baseline[name])
+            for name in sorted(results)
+            if name in baseline and
+            results[name] > baseline[name] * (1 + threshold)]
+
+
+def load_baseline(path=BASELINE_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def save_results(results, path):
+    with open(path, 'w') as f:
+        json.dump({'python': platform.python_version(),
+                   'unit': 'microseconds per operation',
+                   'results': results}, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Times the game logic and compares it with the '
+                    'baseline.')
+    parser.add_argument('--filter', help='Only run benchmarks whose name '
+                                         'contains this.')
+    parser.add_argument('--threshold', type=float,
+                        default=DEFAULT_THRESHOLD)
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--output', help='Also write the results here.')
+    parser.add_argument('--update-baseline', action='store_true')
+    args = parser.parse_args()
+
+    stubbed = appengine_stubs.install()
+    baseline = load_baseline(args.baseline)
+    if args.update_baseline:
+        results = median_results([run_benchmarks(name_filter=args.filter)
+                                  for run in range(BASELINE_RUNS)])
+    else:
+        results = run_benchmarks(name_filter=args.filter)
+        # Time anything that looks slower again, so that one noisy run is
+        # not reported as a regression.
+        retry = [name for name, result, base in
+                 regressions(results, baseline, args.threshold)]
+        if retry:
+            for name, result in run_benchmarks(retry).items():
+                results[name] = min(results[name], result)
+
+    for name in sorted(results):
+        line = '{:45} {:10.2f} us'.format(name, results[name])
+        if name in baseline:
+            line += '  ({:+.0%})'.format(results[name] / baseline[name] - 1)
+        print(line)
+    if stubbed:
+        print('(App Engine SDK not found; ran with stand-ins)')
+
+    if args.output:
+        save_results(results, args.output)
+    if args.update_baseline:
+        baseline.update(results)
+        save_results(baseline, args.baseline)
+        print('Baseline updated.')
+        return 0
+
+    regressed = regressions(results, baseline, args.threshold)
+    for name, result, base in regressed:
+        print('REGRESSION {}: {:.2f} us, baseline {:.2f} us'.format(
+            name, result, base))
+    return 1 if regressed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,80 @@
+import hashlib
+import random
+import struct
+
+"""
+dice.py - Reproducible streams of dice.
+
+Every game draws its dice from its own stream, identified by a 63-bit seed.
+Block i of the stream is the SHA-256 digest of the seed and i; each byte
+below 252 of a block is one die (byte % 6 + 1) and the other bytes are
+skipped, so every face is equally likely.  A block yields about 31 dice,
+and the whole stream is fixed by the seed, so storing the seed and the
+number of dice drawn so far (the offset) on a game is enough to replay
+every roll it will ever make.
+"""
+
+SEED_BITS = 63
+
+_BLOCK = struct.Struct('>QQ')
+_UNBIASED = 252
+
+_system_random = random.SystemRandom()
+
+
+def new_seed():
+    """Returns an unpredictable seed for a new stream."""
+    return _system_random.getrandbits(SEED_BITS)
+
+
+def _block(seed, index):
+    """Returns the dice in block index of the stream for seed."""
+    digest = bytearray(hashlib.sha256(_BLOCK.pack(seed, index)).digest())
+    return [b % 6 + 1 for b in digest if b < _UNBIASED]
+
+
+class DiceStream(object):
+    """Draws dice in order from the stream for seed, starting offset dice
+    in."""
+
+    def __init__(self, seed, offset=0):
+        self.seed = seed
+        self.offset = 0
+        self._index = 0
+        self._buffer = []
+        self._position = 0
+        self.skip(offset)
+
+    def _fill(self):
+        self._buffer = _block(self.seed, self._index)
+        self._index += 1
+        self._position = 0
+
+    def skip(self, count):
+        """Discards the next count dice."""
+        while count > 0:
+            if self._position == len(self._buffer):
+                self._fill()
+            step = min(count, len(self._buffer) - self._position)
+            self._position += step
+            self.offset += step
+            count -= step
+
+    def draw(self, count):
+        """Returns the next count dice."""
+        dice = []
+        while len(dice) < count:
+            if self._position == len(self._buffer):
+                self._fill()
+            end = min(len(self._buffer),
+                      self._position + count - len(dice))
+            dice.extend(self._buffer[self._position:end])
+            self.offset += end - self._position
+            self._position = end
+        return dice
+
+
+def draw(seed, offset, count):
+    """Returns count dice from the stream for seed, starting offset dice
+    in."""
+    return DiceStream(seed, offset).draw(count)
@@ -1,113 +1,163 @@
-import random
+import itertools
+import operator
 from datetime import date
 from protorpc import messages
 from google.appengine.ext import ndb
 
-class CategoryType(messages.Enum):
-    """CategoryType -- enumeration value"""
-    ACES = 1
-    TWOS = 2
-    THREES = 3
-    FOURS = 4
-    FIVES = 5
-    SIXES = 6
-    THREE_OF_A_KIND = 7
-    FOUR_OF_A_KIND = 8
-    FULL_HOUSE = 9
-    SMALL_STRAIGHT = 10
-    LARGE_STRAIGHT = 11
-    YAHTZEE = 12
-    CHANCE = 13
+import background
+import dice
+import game_history
+import leaderboard
+import scorecard
+import scoring
+import storage
+# Registers the entity cache's write listener wherever Games are written,
+# including deferred tasks such as record_final_score.
+import utils
+from properties import CategoryScoresProperty, DiceProperty
+from scorecard import CategoryType
+from scoresheet import CategoryScores
+from user import user_names
+from user_stats import UserStats
+
 
 class Game(ndb.Model):
     """ Game object """
     game_over = ndb.BooleanProperty(required=True, default=False)
     user = ndb.KeyProperty(required=True, kind='User')
-    history = ndb.PickleProperty(required=True)
+    # Binary event log, see game_history.py.
+    history = ndb.BlobProperty(required=True)
     has_incomplete_turn = ndb.BooleanProperty(required=True)
     turn_count = ndb.IntegerProperty(required=True, default=0)
 
     upper_section_total = ndb.IntegerProperty(default=0)
     bonus_points = ndb.IntegerProperty(default=0)
-    category_scores = ndb.PickleProperty(required=True)
+    category_scores = CategoryScoresProperty(required=True)
+    # Indexed 13-bit mask of the filled categories.
+    filled_categories = ndb.ComputedProperty(
+        lambda self: self.category_scores.filled)
     final_score = ndb.IntegerProperty(default=0)
     yahtzee_bonus_count = ndb.IntegerProperty(default=0)
+    # Running total of every score and bonus so far.  None for games
+    # created before it was maintained, see ensure_totals.
+    total_score = ndb.IntegerProperty()
+    # Whether the game has ended but record_final_score has not run yet.
+    score_pending = ndb.BooleanProperty(default=False)
 
-    dice = ndb.PickleProperty(required=True)        
+    dice = DiceProperty(required=True)
     roll_count = ndb.IntegerProperty(required=True, default=0)
+    # The game's stream of dice (see dice.py) and the number drawn from it.
+    # Games created before streams get a seed on their next roll.
+    dice_seed = ndb.IntegerProperty(indexed=False)
+    dice_offset = ndb.IntegerProperty(indexed=False, default=0)
 
     @classmethod
     def new_game(cls, user):
         """Creates and returns a new game"""
         game = Game(user=user)
-        game.history = {}
+        game.history = game_history.new_log()
         game.turn_count = 0
         game.has_incomplete_turn = False
         game.dice = []
+        game.dice_seed = dice.new_seed()
+
+        game.category_scores = CategoryScores()
+        game.total_score = 0
 
-        scores = {}
-        scores['ACES'] = -1
-        scores['TWOS'] = -1
-        scores['THREES'] = -1
-        scores['FOURS'] = -1
-        scores['FIVES'] = -1
-        scores['SIXES'] = -1
-        scores['THREE_OF_A_KIND'] = -1
-        scores['FOUR_OF_A_KIND'] = -1
-        scores['FULL_HOUSE'] = -1
-        scores['SMALL_STRAIGHT'] = -1
-        scores['LARGE_STRAIGHT'] = -1
-        scores['YAHTZEE'] = -1
-        scores['CHANCE'] = -1
-        game.category_scores = scores
-
-        game.put()
+        storage.put(game)
         return game
 
-    def to_form(self):
-        """Returns a GameForm representation of the Game"""
+    @classmethod
+    def to_forms(cls, games):
+        """Returns the GameForm of each game, without its history, reading
+        all of their users at once."""
+        names = user_names(game.user for game in games)
+        return [game.to_form(names, with_history=False) for game in games]
+
+    def to_form(self, names=None, with_history=True):
+        """Returns a GameForm representation of the Game
+        Args:
+            names: The dict of User key to name from user_names, if the
+                game's User was already read with others.  The name is
+                empty if the User was deleted.
+            with_history: Whether to include the turn history, which
+                listings leave out; get_game_history returns it."""
+        self.ensure_totals()
+        if names is None:
+            names = user_names([self.user])
         form = GameForm(urlsafe_key=self.key.urlsafe(),
-                        user_name=self.user.get().name,
+                        user_name=names.get(self.user, ''),
                         game_over=self.game_over,
                         turn_count=self.turn_count,
                         has_incomplete_turn=self.has_incomplete_turn,
                         upper_section_total=self.upper_section_total,
                         bonus_points=self.bonus_points,
-                        category_scores=str(self.category_scores),
+                        category_scores=scorecard.category_score_forms(
+                            self.category_scores),
+                        open_categories=scorecard.open_category_types(
+                            self.category_scores),
                         yahtzee_bonus_count=self.yahtzee_bonus_count,
                         final_score = self.final_score,
+                        total_score=self.total_score,
                         dice=self.dice,
                         roll_count=self.roll_count,
-                        history=str(self.history))
+                        history=self.history_forms() if with_history else [])
         return form
 
+    def history_forms(self, from_turn=None, to_turn=None):
+        """Returns a TurnHistoryForm for each turn of the history, or only
+        for the turns from from_turn to to_turn inclusive if given."""
+        forms = []
+        for turn, events in itertools.groupby(
+                game_history.iter_events(self.history, from_turn, to_turn),
+                operator.attrgetter('turn')):
+            rolls = []
+            score = None
+            for event in events:
+                if isinstance(event, game_history.RollEvent):
+                    rolls.append(RollEventForm(roll_count=event.roll_count,
+                                               dice=event.dice))
+                else:
+                    score = ScoreEventForm(
+                        category_type=CategoryType(event.category + 1),
+                        score=event.score)
+            forms.append(TurnHistoryForm(turn=turn, rolls=rolls,
+                                         score=score))
+        return forms
+
     def can_roll(self):
         return self.roll_count > 0
 
     def roll_again(self, keepers):
         self.roll_count += 1
-        # Choose a random number between 1 and 6 for each die that is not marked as a 'keeper'
+        # Draw a new value for each die that is not marked as a 'keeper'
+        rerolled = iter(self.draw_dice(keepers[:5].count(0)))
         for i in range(5):
             if keepers[i] == 0:
-                value = random.choice(range(1, 7))
-                self.dice[i] = value
-                print value
-        
-        # Update the game history.        
-        entry = (self.roll_count, self.dice)
-        self.update_history(entry)
+                self.dice[i] = next(rerolled)
+
+        # Update the game history.
+        self.update_history(game_history.encode_roll(
+            self.turn_count, self.roll_count, self.dice))
 
         # Save changes
-        self.put()
+        storage.put(self)
 
         # Return GameForm
         return self.to_form()
 
-    def update_history(self, entry):
-        if self.turn_count not in self.history :
-            self.history[self.turn_count] = []
+    def draw_dice(self, count):
+        """Returns the next count dice from the game's stream."""
+        if self.dice_seed is None:
+            self.dice_seed = dice.new_seed()
+            self.dice_offset = 0
+        values = dice.draw(self.dice_seed, self.dice_offset, count)
+        self.dice_offset += count
+        return values
 
-        self.history[self.turn_count].append(entry)
+    def update_history(self, record):
+        """Appends a game_history record to the history."""
+        self.history = game_history.append(self.history, record)
 
     def roll_dice(self):    
         """Rolls the dice for a new turn.  Must score any previous turn before calling this method."""        
@@ -116,210 +166,170 @@ class Game(ndb.Model):
         self.turn_count += 1    
         self.has_incomplete_turn = True
 
-        # Choose a random number between 1 and 6 for each die       
-        for i in range(5):
-            value = random.choice(range(1, 7))
-            self.dice.append(value)
-            print value
-       
+        # Draw a value between 1 and 6 for each die
+        self.dice = self.draw_dice(5)
+
         # Update the game history.
-        entry = (self.roll_count, self.dice)           
-        self.update_history(entry)
+        self.update_history(game_history.encode_roll(
+            self.turn_count, self.roll_count, self.dice))
 
         # Save changes
-        self.put()
+        storage.put(self)
 
         # Return GameForm
         return self.to_form()
 
 
     def score_roll(self, category):
-        frequencies = {}
-        for d in self.dice:
-            if d in frequencies:
-                count = frequencies[d]
-                count += 1
-                frequencies[d] = count
-            else:
-                frequencies[d] = 1
-    
-        score = 0
-        if (category is CategoryType.ACES):
-            # Total of ones only
-            score = self.totalOf(1)            
-
-        elif (category is CategoryType.TWOS):
-            # Total of twos only
-            score = self.totalOf(2)
-
-        elif (category is CategoryType.THREES):
-            # Total of threes only
-            score = self.totalOf(3)
-
-        elif (category is CategoryType.FOURS):
-            # Total of fours only
-            score = self.totalOf(4)
-
-        elif (category is CategoryType.FIVES):
-            # Total of fives only
-            score = self.totalOf(5)
-
-        elif (category is CategoryType.SIXES):
-            # Total of sixes only
-            score = self.totalOf(6)
-
-        elif (category is CategoryType.THREE_OF_A_KIND):
-            # If there are three of a kind, the score is equal to the sum of
-            # all five dice.
-            found = False
-            for d in frequencies:
-                if frequencies[d] >= 3:
-                    found = True
-                    break
-            if found:
-                score = sum(self.dice)
-
-        elif (category is CategoryType.FOUR_OF_A_KIND):
-            # If there are four of a kind, the score is equal to the sum of all
-            # five dice.
-            found = False
-            for d in frequencies:
-                if frequencies[d] >= 4:
-                    found = True
-                    break
-            if found:
-                score = sum(self.dice)
-
-        elif category is CategoryType.FULL_HOUSE:
-            # A full house is worth 25 points.
-            if 2 in frequencies.values() and 3 in frequencies.values():
-                score = 25
-
-        elif category is CategoryType.SMALL_STRAIGHT:
-            # A small straight is worth 30 points.
-            if {1, 2, 3, 4} <= set(self.dice):
-                score = 30
-            elif {2, 3, 4, 5} <= set(self.dice):
-                score = 30
-            elif {3, 4, 5, 6} <= set(self.dice):
-                score = 30
-
-        elif category is CategoryType.LARGE_STRAIGHT:
-            # A large straight is worth 40 points.
-            if {1, 2, 3, 4, 5} <= set(self.dice):
-                score = 40
-            elif {2, 3, 4, 5, 6} <= set(self.dice):
-                score = 40
-
-        elif category is CategoryType.YAHTZEE:
-            # Five of a kind.  A YAHTZEE is worth 50 points.
-
-            # Check to make sure all dice are the same.
-            is_Yahztee = (5 in frequencies.values())
-
-            """If the user rolls YAHTZEE and has already filled in the 
-            YAHZTEE box with 50, they get a 100-point bonus.
-            If they have already filled in the YAHTZEE box with 0, 
-            they do not get a bonus."""
-
-            # Has a score already been entered for the YAHTZEE category?
-            current_score = self.category_scores[str(category)]
-            if current_score == -1:
-                # No score has been entered yet, so score normally.
-                if is_Yahztee:
-                    score = 50
-                else:
-                    score = 0
+        """Scores the current dice in the given category.
+        Ends the game once every category has been scored."""
+        self.ensure_totals()
+        score = scoring.score(self.dice, category)
 
-            elif current_score == 50:
-                """A score of 50 has already been entered, 
-                so increase the YAHTZEE bonus conut."""
-                self.yahzee_bonus_count += 1
+        if scoring.earns_yahtzee_bonus(self.category_scores, self.dice):
+            self.yahtzee_bonus_count += 1
+            self.total_score += scoring.YAHTZEE_BONUS
 
-        elif category is CategoryType.CHANCE:
-            # Sum of all five dice.
-            score = sum(self.dice)
-
-        self.category_scores[str(category)] = score
+        self.category_scores.set(scoring.category_index(category), score)
+        self.add_to_totals(scoring.category_index(category), score)
 
         # Update the game history.
-        entry = (str(category), score)
-        self.update_history(entry)
+        self.update_history(game_history.encode_score(
+            self.turn_count, scoring.category_index(category), score))
 
         # Mark the turn complete
         self.has_incomplete_turn = False
         # Reinitialize items for next turn.
         self.roll_count = 0
         self.dice = []
-        # Save game
-        self.put()
+
+        if self.category_scores.is_full():
+            # The game is over; end_game saves the game.
+            self.final_score = self.total_score
+            self.end_game(self.final_score)
+        else:
+            # Save game
+            storage.put(self)
 
         return self.to_form()
 
+    def add_to_totals(self, category, score):
+        """Adds score, entered in the category at index category, to the
+        running totals.  If a player scores a total of 63 or more points in
+        the upper section, a bonus of 35 points is added."""
+        self.total_score += score
+        if category in scoring.UPPER_SECTION:
+            self.upper_section_total += score
+            if (not self.bonus_points and self.upper_section_total >=
+                    scoring.UPPER_BONUS_THRESHOLD):
+                self.bonus_points = scoring.UPPER_BONUS
+                self.total_score += self.bonus_points
+
+    def ensure_totals(self):
+        """Computes the running totals of a game created before they were
+        maintained.  Does nothing for any other game."""
+        if self.total_score is not None:
+            return
+        self.upper_section_total = self.calculateUpperSectionTotal()
+        if self.upper_section_total >= scoring.UPPER_BONUS_THRESHOLD:
+            self.bonus_points = scoring.UPPER_BONUS
+        self.total_score = (self.category_scores.total() + self.bonus_points +
+                            scoring.YAHTZEE_BONUS * self.yahtzee_bonus_count)
+
 
     def calculateUpperSectionTotal(self):
-        """Returns total of scores in upper section.  
-        Ignores values less than zero."""
-
-        total = 0
-        if self.category_scores['ACES'] != -1:
-            total += self.category_scores['ACES']
-        if self.category_scores['TWOS'] != -1:
-            total += self.category_scores['TWOS']
-        if self.category_scores['THREES'] != -1:
-            total += self.category_scores['THREES']
-        if self.category_scores['FOURS'] != -1:
-            total += self.category_scores['FOURS']
-        if self.category_scores['FIVES'] != -1:
-            total += self.category_scores['FIVES']
-        if self.category_scores['SIXES'] != -1:
-            total += self.category_scores['SIXES']
-
-        return total        
-
-    def totalOf(self, value):
-        """
-        Returns the sum of dice of a given value.
-        For example, if dice = [1,3,5,3,4] and value = 3, 
-        then 6 (3+3) is returned.
-        """
-        score = 0
-        for d in self.dice:
-            if d is value:
-                score += d
-        return score
-
-    def end_game(self, score):        
+        """Returns total of scores in upper section.
+        Ignores categories not yet scored."""
+        return self.category_scores.upper_section_total()
+
+    def end_game(self, score, changed=()):
+        """Ends the game with score.  Stores the game and the other changed
+        entities in one transaction that also queues record_final_score,
+        so the user's totals, the Score and the leaderboard are updated
+        after the response."""
         self.game_over = True
-        self.put()
-
-        # Update the user
-        # Get the user
-        user = self.user.get()
+        self.score_pending = True
+
+        def end():
+            storage.put_multi([self] + list(changed))
+            background.defer(record_final_score, self.key, date.today())
+
+        storage.run_in_transaction(end)
+
+
+def record_final_score(game_key, day):
+    """Background task that records the final score of a finished game:
+    the user's high score and games played, their UserStats, a Score and
+    the leaderboard are stored with one put_multi in a single transaction,
+    which also queues leaderboard.record_game_score for the daily, weekly
+    and all-time leaderboards.  Does nothing once the score is recorded,
+    so it is safe to run more than once."""
+    def record():
+        game = storage.get(game_key)
+        if not game or not game.score_pending:
+            return
+        game.score_pending = False
+        entities = [game, Score(user=game.user, date=day,
+                                score=game.final_score)]
         # Set the new high score for the user
-        user.add_score(score)
-        # Save changes made to user
-        user.put()
-
-        # Add the game to the score board.
-        score = Score(user=self.user, date=date.today(), score=score)
-        score.put()
-    
-    
+        user, stats = storage.get_multi([game.user,
+                                         UserStats.key_for(game.user)])
+        if user:
+            entities.extend(user.add_score(game.final_score))
+            stats = UserStats.for_user(game.user, stats)
+            stats.add_game(game)
+            entities.append(stats)
+            background.defer(leaderboard.record_game_score, game.key,
+                             user.name, game.final_score, day)
+        storage.put_multi(entities)
+
+    storage.run_in_transaction(record)
+
+
 class Score(ndb.Model):
     """Score object"""
     user = ndb.KeyProperty(required=True, kind='User')
     date = ndb.DateProperty(required=True)    
     score = ndb.IntegerProperty(required=True)    
 
-    def to_form(self):
-        return ScoreForm(user_name=self.user.get().name,
+    @classmethod
+    def to_forms(cls, scores):
+        """Returns the ScoreForm of each score, reading all of their users
+        at once."""
+        names = user_names(score.user for score in scores)
+        return [score.to_form(names) for score in scores]
+
+    def to_form(self, names=None):
+        """Returns a ScoreForm; names is as for Game.to_form."""
+        if names is None:
+            names = user_names([self.user])
+        return ScoreForm(user_name=names.get(self.user, ''),
                          date=str(self.date), 
                          score=self.score)
 
 
 # Forms
 
+class RollEventForm(messages.Message):
+    """RollEventForm for one roll of the dice in a turn"""
+    roll_count = messages.IntegerField(1, required=True)
+    dice = messages.IntegerField(2, repeated=True)
+
+
+class ScoreEventForm(messages.Message):
+    """ScoreEventForm for the category a turn was scored in"""
+    category_type = messages.EnumField(CategoryType, 1, required=True)
+    score = messages.IntegerField(2, required=True)
+
+
+class TurnHistoryForm(messages.Message):
+    """TurnHistoryForm for the rolls of a turn and, once it is scored,
+    its score"""
+    turn = messages.IntegerField(1, required=True)
+    rolls = messages.MessageField(RollEventForm, 2, repeated=True)
+    score = messages.MessageField(ScoreEventForm, 3)
+
+
 class GameForm(messages.Message):
     """GameForm for outbound game state information"""
     urlsafe_key = messages.StringField(1, required=True)
@@ -329,16 +339,21 @@ class GameForm(messages.Message):
     has_incomplete_turn = messages.BooleanField(5, required=True)
     upper_section_total = messages.IntegerField(6, required=True)
     bonus_points = messages.IntegerField(7, required=True)
-    category_scores = messages.StringField(8, required=True)
+    category_scores = messages.MessageField(scorecard.CategoryScoreForm, 8,
+                                            repeated=True)
     yahtzee_bonus_count = messages.IntegerField(9, required=True)
     final_score = messages.IntegerField(10, required=True)
     dice = messages.IntegerField(11, repeated=True)
     roll_count = messages.IntegerField(12, required=True)
-    history = messages.StringField(13, required=True) 
+    history = messages.MessageField(TurnHistoryForm, 13, repeated=True)
+    total_score = messages.IntegerField(14, required=True)
+    open_categories = messages.EnumField(CategoryType, 15, repeated=True)
 
 class GameForms(messages.Message):
     """Form to return list of games"""
-    games = messages.MessageField(GameForm, 1, repeated=True)        
+    games = messages.MessageField(GameForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
+    more = messages.BooleanField(3)
 
 
 class ScoreForm(messages.Message):
@@ -362,7 +377,28 @@ class StringMessage(messages.Message):
     message = messages.StringField(1, required=True)
 
 class GameHistoryForm(messages.Message):
-    history = messages.StringField(1, required=True)    
+    """GameHistoryForm for the history of a range of a game's turns"""
+    turns = messages.MessageField(TurnHistoryForm, 1, repeated=True)
+    turn_count = messages.IntegerField(2, required=True)
 
 class ScoreRollForm(messages.Message):
-    category_type = messages.EnumField('CategoryType', 1)        
+    category_type = messages.EnumField(CategoryType, 1)
+
+
+class CategorySuggestionForm(messages.Message):
+    """Best category to score the current dice in"""
+    category_type = messages.EnumField(CategoryType, 1, required=True)
+    score = messages.IntegerField(2, required=True)
+    expected_value = messages.FloatField(3, required=True)
+
+
+class KeepersForm(messages.Message):
+    """Keepers for roll_again and the expected final points of holding them"""
+    keepers = messages.IntegerField(1, repeated=True)
+    expected_value = messages.FloatField(2, required=True)
+
+
+class KeepersSuggestionForm(messages.Message):
+    """Best keepers for the current dice, followed by the alternatives"""
+    best = messages.MessageField(KeepersForm, 1, required=True)
+    alternatives = messages.MessageField(KeepersForm, 2, repeated=True)
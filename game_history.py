@@ -0,0 +1,129 @@
+import pickle
+import struct
+from collections import namedtuple
+
+import scoring
+import scoresheet
+
+"""
+game_history.py - Compact append-only binary encoding of Game.history.
+
+A history log is one version byte followed by a fixed-width 4-byte record
+per event, in the order the events happened:
+
+    byte 0     turn number
+    byte 1     event type in the high nibble (0 roll, 1 score) and the
+               roll count (1-3) or category index (0-12) in the low nibble
+    bytes 2-3  big-endian: the five dice packed 3 bits each for a roll,
+               or the score for a score
+
+Recording a move appends 4 bytes, and a complete game is about 200 bytes.
+Records are in turn order, so the events of a range of turns are found by
+binary search without decoding the turns before them.
+Histories written before this format are pickled dicts of per-turn lists of
+(roll_count, dice) and (category, score) tuples; they are recognised by
+their first byte and converted by migrate.
+"""
+
+VERSION = 1
+HEADER = struct.pack('B', VERSION)
+
+_RECORD = struct.Struct('>BBH')
+RECORD_SIZE = _RECORD.size
+_TURN = struct.Struct('B')
+
+_ROLL = 0
+_SCORE = 1
+
+RollEvent = namedtuple('RollEvent', ['turn', 'roll_count', 'dice'])
+ScoreEvent = namedtuple('ScoreEvent', ['turn', 'category', 'score'])
+
+
+def new_log():
+    """Returns an empty history log."""
+    return HEADER
+
+
+def encode_roll(turn, roll_count, dice):
+    """Returns the record for rolling dice on roll roll_count of turn."""
+    return _RECORD.pack(turn, (_ROLL << 4) | roll_count,
+                        scoresheet.dice_to_bits(dice))
+
+
+def encode_score(turn, category, score):
+    """Returns the record for scoring score in the category at index
+    category on turn."""
+    return _RECORD.pack(turn, (_SCORE << 4) | category, score)
+
+
+def is_legacy(log):
+    """Returns whether log is a pickled history from before this format."""
+    return bool(log) and log[:1] != HEADER
+
+
+def migrate(log):
+    """Returns log in the current format, converting a legacy history."""
+    if not log:
+        return new_log()
+    if not is_legacy(log):
+        return log
+    return from_legacy(pickle.loads(log))
+
+
+def from_legacy(history):
+    """Encodes a legacy history dict."""
+    records = [new_log()]
+    for turn in sorted(history):
+        for first, second in history[turn]:
+            if isinstance(first, int):
+                records.append(encode_roll(turn, first, second))
+            else:
+                records.append(encode_score(
+                    turn, scoring.CATEGORY_NAMES.index(first), second))
+    return b''.join(records)
+
+
+def append(log, record):
+    """Returns log with record appended, migrating a legacy log first."""
+    return migrate(log) + record
+
+
+def _offset(log, turn):
+    """Returns the offset of the first record of log for turn or a later
+    turn."""
+    low, high = 0, (len(log) - len(HEADER)) // RECORD_SIZE
+    while low < high:
+        middle = (low + high) // 2
+        if _TURN.unpack_from(
+                log, len(HEADER) + middle * RECORD_SIZE)[0] < turn:
+            low = middle + 1
+        else:
+            high = middle
+    return len(HEADER) + low * RECORD_SIZE
+
+
+def iter_events(log, from_turn=None, to_turn=None):
+    """Yields a RollEvent or ScoreEvent for every event in log, in order,
+    or only for the turns from from_turn to to_turn inclusive if given."""
+    log = migrate(log)
+    start = len(HEADER) if from_turn is None else _offset(log, from_turn)
+    end = len(log) if to_turn is None else _offset(log, to_turn + 1)
+    for offset in range(start, end, RECORD_SIZE):
+        turn, kind, value = _RECORD.unpack_from(log, offset)
+        if kind >> 4 == _ROLL:
+            yield RollEvent(turn, kind & 15, scoresheet.bits_to_dice(value))
+        else:
+            yield ScoreEvent(turn, kind & 15, value)
+
+
+def decode(log):
+    """Returns the history as a dict of per-turn lists of (roll_count, dice)
+    and (category name, score) tuples, the format of legacy histories."""
+    history = {}
+    for event in iter_events(log):
+        if isinstance(event, RollEvent):
+            entry = (event.roll_count, event.dice)
+        else:
+            entry = (scoring.CATEGORY_NAMES[event.category], event.score)
+        history.setdefault(event.turn, []).append(entry)
+    return history
@@ -0,0 +1,373 @@
+import array
+import zlib
+from datetime import date, timedelta
+
+from protorpc import messages
+from google.appengine.ext import ndb
+
+import background
+import storage
+
+"""
+leaderboard.py - Maintained leaderboard of the best score of each user.
+
+Users are hashed to one of NUM_SHARDS LeaderboardShard entities, so that
+games ending at the same time rarely write the same entity.  Each shard
+keeps its TOP_K best (score, user) entries in order and a Fenwick tree
+counting its users at every possible score.  Reading the top N scores
+merges the shards' lists, and finding the rank of a score sums a
+logarithmic number of tree cells per shard, so neither depends on the
+number of users.
+
+The shards are updated whenever a user's best score changes.  Lowering or
+removing a score that was in a shard's list can leave that list shorter
+than TOP_K while the shard has more users; a refill_shard task then tops it
+up from the User entities.  /tasks/rebuild_leaderboard recomputes every
+shard from scratch into a copy of the board, a page of Users per
+transaction, and replaces the board with the copy once every User is
+read.
+
+The best games of each day, each ISO week and of all time are kept in one
+ScoreBucket entity per period, holding its TOP_K best scores, so reading
+any period is a single get.  record_game_score adds a finished game to
+its buckets, and only writes the buckets its score gets into.  Daily and
+weekly buckets expire after DAILY_RETENTION and WEEKLY_RETENTION days and
+are deleted by the /crons/roll_over_leaderboards cron job.
+"""
+
+TOP_K = 100
+NUM_SHARDS = 10
+
+# The highest score possible in a game: every category at its maximum,
+# the upper section bonus and a YAHTZEE bonus on each of the other 12 turns.
+MAX_SCORE = 1575
+
+ALL_TIME = 'all-time'
+
+_TREE_SIZE = MAX_SCORE + 2
+
+DAILY_RETENTION = 35
+WEEKLY_RETENTION = 26 * 7
+
+
+class Period(messages.Enum):
+    """Period -- enumeration value"""
+    DAILY = 1
+    WEEKLY = 2
+    ALL_TIME = 3
+
+
+class LeaderboardShard(ndb.Model):
+    """One shard of a leaderboard"""
+    scores = ndb.IntegerProperty(repeated=True, indexed=False)
+    users = ndb.KeyProperty(kind='User', repeated=True, indexed=False)
+    # Fenwick tree over scores, packed as an array of ints.
+    counts = ndb.BlobProperty()
+
+    def tree(self):
+        if self.counts:
+            return array.array('i', self.counts)
+        return array.array('i', [0] * _TREE_SIZE)
+
+    def entries(self):
+        """Returns the shard's (score, user key) entries, best first."""
+        return zip(self.scores, self.users)
+
+    def set_entries(self, entries):
+        entries = sorted(entries, key=lambda entry: entry[0],
+                         reverse=True)[:TOP_K]
+        self.scores = [score for score, user in entries]
+        self.users = [user for score, user in entries]
+
+
+def check_score(score):
+    """Raises ValueError unless score is a possible game score."""
+    if not 0 <= score <= MAX_SCORE:
+        raise ValueError('Scores must be between 0 and {}, got {}'.format(
+            MAX_SCORE, score))
+
+
+def _add(tree, score, delta):
+    """Adds delta to the number of users with score."""
+    check_score(score)
+    i = score + 1
+    while i < _TREE_SIZE:
+        tree[i] += delta
+        i += i & -i
+
+
+def _count_at_most(tree, score):
+    """Returns the number of users with score or less."""
+    i = min(score, MAX_SCORE) + 1
+    total = 0
+    while i > 0:
+        total += tree[i]
+        i -= i & -i
+    return total
+
+
+def _count(tree, score):
+    """Returns the number of users with exactly score."""
+    below = _count_at_most(tree, score - 1) if score > 0 else 0
+    return _count_at_most(tree, score) - below
+
+
+def shard_key(board, shard):
+    return ndb.Key(LeaderboardShard, '{}:{}'.format(board, shard))
+
+
+def _shard_for(user_key):
+    return zlib.crc32(str(user_key.id())) % NUM_SHARDS
+
+
+def _shards(board):
+    return [shard for shard in storage.get_multi(
+        [shard_key(board, i) for i in range(NUM_SHARDS)]) if shard]
+
+
+def updated_shard(user_key, old_score, new_score, board=ALL_TIME):
+    """Returns the leaderboard shard of user_key with the user moved from
+    old_score to new_score, for the caller to store in the transaction it
+    was read in.  old_score is None for a user not yet on the leaderboard,
+    and new_score is None to remove the user.  Raises ValueError if
+    new_score is not a possible score."""
+    index = _shard_for(user_key)
+    key = shard_key(board, index)
+    shard = storage.get(key) or LeaderboardShard(key=key)
+
+    tree = shard.tree()
+    # Users from before the leaderboard are only counted once it is
+    # rebuilt, and their scores were never checked, so an old score is
+    # only taken off the tree if some user is counted at it.
+    if old_score is not None and 0 <= old_score <= MAX_SCORE and \
+            _count(tree, old_score) > 0:
+        _add(tree, old_score, -1)
+    if new_score is not None:
+        _add(tree, new_score, 1)
+    shard.counts = tree.tostring()
+
+    entries = [entry for entry in shard.entries() if entry[1] != user_key]
+    if new_score is not None:
+        entries.append((new_score, user_key))
+    shard.set_entries(entries)
+    if len(shard.scores) < min(TOP_K, _count_at_most(tree, MAX_SCORE)):
+        # Deferred in the caller's transaction, so it only runs if the
+        # shard is stored.
+        background.defer(refill_shard, board, index)
+    return shard
+
+
+def refill_shard(board, index):
+    """Task: tops up the list of a shard that has fewer than TOP_K entries
+    but more users, with the best Users hashed to it."""
+    # Imported here since user.py imports this module.
+    from user import User
+
+    key = shard_key(board, index)
+    shard = storage.get(key)
+    if not shard or len(shard.scores) >= TOP_K:
+        return
+    # The query is only eventually consistent, so the Users found are read
+    # again by key.
+    found = []
+    for user in storage.iterate(User, order='-high_score'):
+        if user.is_ranked() and _shard_for(user.key) == index:
+            found.append(user.key)
+            if len(found) == TOP_K:
+                break
+    users = [user for user in storage.get_multi(found) if user]
+
+    def refill():
+        shard = storage.get(key)
+        listed = set(shard.users)
+        shard.set_entries(shard.entries() + [
+            (user.high_score, user.key) for user in users
+            if user.key not in listed and user.is_ranked()])
+        storage.put(shard)
+
+    storage.run_in_transaction(refill)
+
+
+def top(n=TOP_K, board=ALL_TIME):
+    """Returns up to min(n, TOP_K) (score, user key) entries, best first."""
+    entries = []
+    for shard in _shards(board):
+        entries.extend(shard.entries())
+    entries.sort(key=lambda entry: entry[0], reverse=True)
+    return entries[:min(n, TOP_K)]
+
+
+def rank(score, board=ALL_TIME):
+    """Returns the rank a score has on a leaderboard (1 for the best) and
+    the number of users on it."""
+    better = 0
+    total = 0
+    for shard in _shards(board):
+        tree = shard.tree()
+        users = _count_at_most(tree, MAX_SCORE)
+        better += users - _count_at_most(tree, score)
+        total += users
+    return better + 1, total
+
+
+class RebuildProgress(ndb.Model):
+    """The number of pages of Users added to a leaderboard's rebuild"""
+    pages = ndb.IntegerProperty(default=0, indexed=False)
+
+
+def _rebuild_board(board):
+    return board + ':rebuild'
+
+
+def start_rebuild(board=ALL_TIME):
+    """Clears the copy of board that rebuild_page fills."""
+    storage.put_multi(
+        [LeaderboardShard(key=shard_key(_rebuild_board(board), i))
+         for i in range(NUM_SHARDS)] +
+        [RebuildProgress(key=ndb.Key(RebuildProgress, board))])
+
+
+def _add_page(page, entries, board):
+    progress = storage.get(ndb.Key(RebuildProgress, board))
+    # A task run again must not count its pages twice.
+    if progress is None or progress.pages != page:
+        return
+    shards = storage.get_multi([shard_key(_rebuild_board(board), i)
+                                for i in range(NUM_SHARDS)])
+    trees = [shard.tree() for shard in shards]
+    shard_entries = [shard.entries() for shard in shards]
+    for score, user_key in entries:
+        i = _shard_for(user_key)
+        _add(trees[i], score, 1)
+        shard_entries[i].append((score, user_key))
+    for shard, tree, entries in zip(shards, trees, shard_entries):
+        shard.counts = tree.tostring()
+        shard.set_entries(entries)
+    progress.pages += 1
+    storage.put_multi(shards + [progress])
+
+
+def rebuild_page(page, entries, board=ALL_TIME):
+    """Adds (score, user key) entries, the page-th page of Users since
+    start_rebuild, to the copy of board, unless that page was added
+    already."""
+    storage.run_in_transaction(_add_page, page, entries, board)
+
+
+def finish_rebuild(board=ALL_TIME):
+    """Replaces board with the copy filled by rebuild_page."""
+    copies = storage.get_multi([shard_key(_rebuild_board(board), i)
+                                for i in range(NUM_SHARDS)])
+    if None in copies:
+        return
+    shards = [LeaderboardShard(key=shard_key(board, i), scores=copy.scores,
+                               users=copy.users, counts=copy.counts)
+              for i, copy in enumerate(copies)]
+    storage.put_multi(shards)
+    storage.delete_multi([copy.key for copy in copies] +
+                         [ndb.Key(RebuildProgress, board)])
+
+
+# Leaderboards of the best games of a period
+
+class ScoreBucket(ndb.Model):
+    """The best games of one period, best first"""
+    scores = ndb.IntegerProperty(repeated=True, indexed=False)
+    games = ndb.KeyProperty(kind='Game', repeated=True, indexed=False)
+    user_names = ndb.StringProperty(repeated=True, indexed=False)
+    expires = ndb.DateProperty(required=True)
+
+    def qualifies(self, score):
+        """Returns whether score would get into the bucket."""
+        return len(self.scores) < TOP_K or score > self.scores[-1]
+
+    def add(self, game_key, user_name, score):
+        entries = zip(self.scores, self.games, self.user_names)
+        entries.append((score, game_key, user_name))
+        entries.sort(key=lambda entry: entry[0], reverse=True)
+        del entries[TOP_K:]
+        self.scores = [entry[0] for entry in entries]
+        self.games = [entry[1] for entry in entries]
+        self.user_names = [entry[2] for entry in entries]
+
+    def to_form(self, period, day):
+        return LeaderboardForm(
+            period=period,
+            date=str(day),
+            entries=[LeaderboardEntryForm(user_name=user_name, score=score)
+                     for score, user_name in zip(self.scores,
+                                                 self.user_names)])
+
+
+def bucket_key(period, day):
+    """Returns the key of the ScoreBucket of the period containing day."""
+    if period == Period.DAILY:
+        name = 'daily:{}'.format(day.isoformat())
+    elif period == Period.WEEKLY:
+        year, week, weekday = day.isocalendar()
+        name = 'weekly:{}-W{:02d}'.format(year, week)
+    else:
+        name = ALL_TIME
+    return ndb.Key(ScoreBucket, name)
+
+
+def _expires(period, day):
+    if period == Period.DAILY:
+        return day + timedelta(days=DAILY_RETENTION)
+    if period == Period.WEEKLY:
+        return (day - timedelta(days=day.weekday()) +
+                timedelta(days=WEEKLY_RETENTION))
+    return date.max
+
+
+def _add_to_bucket(period, day, game_key, user_name, score):
+    key = bucket_key(period, day)
+    bucket = storage.get(key) or ScoreBucket(key=key,
+                                             expires=_expires(period, day))
+    # The game may already be there if the task is run again.
+    if game_key in bucket.games or not bucket.qualifies(score):
+        return
+    bucket.add(game_key, user_name, score)
+    storage.put(bucket)
+
+
+def record_game_score(game_key, user_name, score, day):
+    """Background task that adds a finished game's score, recorded on day,
+    to the daily, weekly and all-time buckets it gets into.  Each bucket is
+    updated in its own transaction, and only if the score qualifies."""
+    periods = list(Period)
+    buckets = storage.get_multi([bucket_key(period, day)
+                                 for period in periods])
+    for period, bucket in zip(periods, buckets):
+        if bucket is None or bucket.qualifies(score):
+            storage.run_in_transaction(_add_to_bucket, period, day,
+                                       game_key, user_name, score)
+
+
+def top_scores(period, day):
+    """Returns the ScoreBucket of the period containing day, or None if no
+    game has been recorded in it."""
+    return storage.get(bucket_key(period, day))
+
+
+def roll_over(today):
+    """Deletes the buckets that expired before today and returns their
+    number."""
+    expired = storage.query(ScoreBucket, [('expires', '<', today)])
+    storage.delete_multi([bucket.key for bucket in expired])
+    return len(expired)
+
+
+# Forms
+
+class LeaderboardEntryForm(messages.Message):
+    """LeaderboardEntryForm for one game on a leaderboard"""
+    user_name = messages.StringField(1, required=True)
+    score = messages.IntegerField(2, required=True)
+
+
+class LeaderboardForm(messages.Message):
+    """LeaderboardForm for the best games of a period, best first"""
+    period = messages.EnumField(Period, 1, required=True)
+    date = messages.StringField(2, required=True)
+    entries = messages.MessageField(LeaderboardEntryForm, 3, repeated=True)
@@ -0,0 +1,79 @@
+import logging
+import os
+import threading
+from collections import namedtuple
+
+from google.appengine.api import mail
+
+"""
+mailer.py - Pluggable outgoing mail.
+
+Code that sends email hands a list of Email messages to the active mailer
+instead of calling mail.send_mail directly:
+
+    AppEngineMailer   sends through the App Engine Mail API (the default)
+    LocalMailer       logs the messages and keeps them in memory, for the
+                      development server and load tests
+
+The mailer is chosen with the YAHTZEE_MAILER environment variable
+('appengine' or 'local') or with set_mailer.
+"""
+
+Email = namedtuple('Email', ['sender', 'to', 'subject', 'body'])
+
+
+class Mailer(object):
+    """Interface implemented by every mailer."""
+
+    def send_batch(self, emails):
+        """Sends every Email in emails."""
+        raise NotImplementedError
+
+
+class AppEngineMailer(Mailer):
+    """Sends email with the App Engine Mail API."""
+
+    def send_batch(self, emails):
+        # The Mail API takes one message per call.
+        for email in emails:
+            mail.send_mail(email.sender, email.to, email.subject, email.body)
+
+
+class LocalMailer(Mailer):
+    """Logs email and keeps it in outbox instead of sending it."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.outbox = []
+
+    def send_batch(self, emails):
+        with self._lock:
+            self.outbox.extend(emails)
+        logging.info('Not sending %d emails', len(emails))
+
+
+_mailer = None
+
+
+def _from_environment():
+    if os.environ.get('YAHTZEE_MAILER', 'appengine') == 'local':
+        return LocalMailer()
+    return AppEngineMailer()
+
+
+def get_mailer():
+    """Returns the active mailer."""
+    global _mailer
+    if _mailer is None:
+        _mailer = _from_environment()
+    return _mailer
+
+
+def set_mailer(mailer):
+    """Replaces the active mailer, e.g. with a LocalMailer for a load test."""
+    global _mailer
+    _mailer = mailer
+
+
+def send_batch(emails):
+    get_mailer().send_batch(emails)
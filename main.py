@@ -2,42 +2,149 @@
 
 """main.py - This file contains handlers that are called by taskqueue and/or
 cronjobs."""
+import datetime
 import logging
+import time
 
 import webapp2
-from google.appengine.api import mail, app_identity
+from protorpc import protojson
 # from api import GuessANumberApi
 
-from user import User
-from game import Game
+import leaderboard
+import metrics
+import migrations
+import reminders
+import utils
 
 
 class SendReminderEmail(webapp2.RequestHandler):
     def get(self):
-        """Send a reminder email to each User with an email who has
-        games in progress. Email body includes a count of active games and their
-        urlsafe keys
+        """Queue the tasks that send a reminder email to each User with an
+        email who has games in progress, one per range of Users.
         Called every hour using a cron job"""
-        app_id = app_identity.get_application_id()
-        users = User.query(User.email != None)
-        for user in users:
-            # Query for Users which have games in progress.
-            games = Game.query(Game.user == user.key).\
-                filter(Game.game_over == False)
-            if games.count() > 0:
-                subject = 'This is a reminder!'
-                body = 'Hello {}, you have {} games in progress. Their' \
-                       ' keys are: {}'.\
-                       format(user.name, games.count()
-                        ,', '.join(game.key.urlsafe() for game in games))
-                logging.debug(body)
-
-            # This will send test emails, the arguments to send_mail are:
-            # from, to, subject, body
-            mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                           user.email,
-                           subject,
-                           body)
+        shards = reminders.queue_shards()
+        logging.info('Queued %d reminder tasks', shards)
+
+
+class RollOverLeaderboards(webapp2.RequestHandler):
+    def get(self):
+        """Delete the daily and weekly leaderboards that have expired.
+        Called every day using a cron job"""
+        deleted = leaderboard.roll_over(datetime.date.today())
+        logging.info('Deleted %d expired leaderboards', deleted)
+
+
+class SendReminderShard(webapp2.RequestHandler):
+    def post(self):
+        """Send the reminder emails for a range of User ids. Email body
+        includes a count of active games and their urlsafe keys.
+        Queues a task for the rest of the range if time runs out."""
+        start = int(self.request.get('start'))
+        end = int(self.request.get('end'))
+        resume = reminders.send_reminders(
+            start, end, time.time() + reminders.TASK_TIME_LIMIT)
+        if resume is not None:
+            reminders.queue_range(resume, end)
+        self.response.set_status(204)
+
+
+class ApiMetrics(webapp2.RequestHandler):
+    def get(self):
+        """Return the latency, datastore usage and response size of each
+        API method called on this instance, as JSON."""
+        self.response.content_type = 'application/json'
+        self.response.write(protojson.encode_message(
+            metrics.get_metrics().to_form()))
+
+
+class EntityCacheStats(webapp2.RequestHandler):
+    def get(self):
+        """Return the hit, miss, update and invalidation counts of the
+        entity cache on this instance, as JSON."""
+        self.response.content_type = 'application/json'
+        self.response.write(protojson.encode_message(
+            utils.get_entity_cache().to_form()))
+
+
+class MigrateGameHistory(webapp2.RequestHandler):
+    def get(self):
+        """Queue the task that converts every Game history stored as a
+        pickled dict to the binary log format in game_history.py.
+        Run once after deploying the new format."""
+        migrations.queue(self.request.path)
+        logging.info('Queued the migration of every game history')
+
+    def post(self):
+        """Convert the Game histories from the cursor, in batches.
+        Queues a task for the rest if time runs out."""
+        resume = migrations.migrate_history(
+            self.request.get('cursor') or None,
+            time.time() + migrations.TASK_TIME_LIMIT)
+        if resume is not None:
+            migrations.queue(self.request.path, cursor=resume)
+        self.response.set_status(204)
+
+
+class RebuildLeaderboard(webapp2.RequestHandler):
+    def get(self):
+        """Clear a copy of the leaderboard and queue the task that fills
+        it from every User's high score."""
+        leaderboard.start_rebuild()
+        migrations.queue(self.request.path, page=0)
+        logging.info('Queued the rebuild of the leaderboard')
+
+    def post(self):
+        """Add the high scores of the Users from the cursor, a batch at a
+        time, and replace the leaderboard after the last one.
+        Queues a task for the rest if time runs out."""
+        resume = migrations.rebuild_leaderboard(
+            int(self.request.get('page')),
+            self.request.get('cursor') or None,
+            time.time() + migrations.TASK_TIME_LIMIT)
+        if resume is not None:
+            page, cursor = resume
+            migrations.queue(self.request.path, page=page, cursor=cursor)
+        self.response.set_status(204)
+
+
+class RebuildUserStats(webapp2.RequestHandler):
+    def get(self):
+        """Queue the task that recomputes every UserStats from the User's
+        finished games.
+        Run once to include the games finished before UserStats."""
+        migrations.queue(self.request.path)
+        logging.info('Queued the rebuild of the user statistics')
+
+    def post(self):
+        """Recompute the UserStats of the Users from the start id.
+        Queues a task for the rest if time runs out."""
+        start = self.request.get('start')
+        resume = migrations.rebuild_user_stats(
+            int(start) if start else None,
+            time.time() + migrations.TASK_TIME_LIMIT)
+        if resume is not None:
+            migrations.queue(self.request.path, start=resume)
+        self.response.set_status(204)
+
+
+class IndexUserNames(webapp2.RequestHandler):
+    def get(self):
+        """Queue the task that creates the UserName entity of every User
+        created before user names were indexed.
+        User.get_by_name indexes the others' names as they are looked
+        up; run once after deploying the index to index the rest."""
+        migrations.queue(self.request.path)
+        logging.info('Queued the indexing of every user name')
+
+    def post(self):
+        """Index the names of the Users from the cursor, in batches.
+        Queues a task for the rest if time runs out."""
+        resume = migrations.index_user_names(
+            self.request.get('cursor') or None,
+            time.time() + migrations.TASK_TIME_LIMIT)
+        if resume is not None:
+            migrations.queue(self.request.path, cursor=resume)
+        self.response.set_status(204)
 
 
 # class UpdateAverageMovesRemaining(webapp2.RequestHandler):
@@ -49,5 +156,13 @@ class SendReminderEmail(webapp2.RequestHandler):
 
 app = webapp2.WSGIApplication([
     ('/crons/send_reminder', SendReminderEmail),
+    ('/crons/roll_over_leaderboards', RollOverLeaderboards),
+    ('/admin/metrics', ApiMetrics),
+    ('/admin/cache_stats', EntityCacheStats),
+    ('/tasks/send_reminders', SendReminderShard),
+    ('/tasks/migrate_history', MigrateGameHistory),
+    ('/tasks/rebuild_leaderboard', RebuildLeaderboard),
+    ('/tasks/index_user_names', IndexUserNames),
+    ('/tasks/rebuild_user_stats', RebuildUserStats),
     # ('/tasks/cache_average_attempts', UpdateAverageMovesRemaining),
 ], debug=True)
@@ -0,0 +1,237 @@
+import bisect
+import functools
+import logging
+import math
+import random
+import threading
+import time
+
+from protorpc import messages
+from protorpc import protojson
+
+import storage
+
+"""
+metrics.py - Latency and datastore usage of each API method.
+
+Decorating an endpoints method with instrumented records, for every call,
+its latency in a histogram, the entities it read, wrote and deleted and the
+queries it ran through storage.py, and, for a sample of
+RESPONSE_SAMPLE_RATE of its calls, the size of its JSON response:
+
+    @endpoints.method(...)
+    @metrics.instrumented
+    def roll_dice(self, request):
+
+Metrics are kept per instance, from its start.  They are logged every
+DUMP_INTERVAL seconds by the next call to finish, and are returned as JSON
+by /admin/metrics (see main.py).
+"""
+
+# Upper bounds, in milliseconds, of the latency histogram buckets; slower
+# calls fall in a last, unbounded bucket.
+LATENCY_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+DUMP_INTERVAL = 5 * 60
+OPERATIONS = ('get', 'put', 'delete', 'query')
+# Encoding a response again only to measure it costs about as much as the
+# endpoints framework's own encoding, so only this fraction of calls pay it.
+RESPONSE_SAMPLE_RATE = 0.05
+
+
+class LatencyBucketForm(messages.Message):
+    """LatencyBucketForm for the calls at most upper_bound_ms long (no
+    bound for the last bucket)"""
+    upper_bound_ms = messages.IntegerField(1)
+    count = messages.IntegerField(2, required=True)
+
+
+class MethodMetricsForm(messages.Message):
+    """MethodMetricsForm for the calls to one API method"""
+    name = messages.StringField(1, required=True)
+    calls = messages.IntegerField(2, required=True)
+    errors = messages.IntegerField(3, required=True)
+    mean_ms = messages.FloatField(4, required=True)
+    p50_ms = messages.IntegerField(5, required=True)
+    p95_ms = messages.IntegerField(6, required=True)
+    p99_ms = messages.IntegerField(7, required=True)
+    max_ms = messages.IntegerField(8, required=True)
+    latency = messages.MessageField(LatencyBucketForm, 9, repeated=True)
+    gets = messages.IntegerField(10, required=True)
+    puts = messages.IntegerField(11, required=True)
+    deletes = messages.IntegerField(12, required=True)
+    queries = messages.IntegerField(13, required=True)
+    mean_response_bytes = messages.FloatField(14, required=True)
+    max_response_bytes = messages.IntegerField(15, required=True)
+    sampled_responses = messages.IntegerField(16, required=True)
+
+
+class MetricsForm(messages.Message):
+    """MetricsForm for every instrumented method called on this instance"""
+    since = messages.StringField(1, required=True)
+    methods = messages.MessageField(MethodMetricsForm, 2, repeated=True)
+
+
+class MethodMetrics(object):
+    """Running totals of the calls to one method."""
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.errors = 0
+        self.latency = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.operations = dict.fromkeys(OPERATIONS, 0)
+        self.sampled_responses = 0
+        self.response_bytes = 0
+        self.max_response_bytes = 0
+
+    def add(self, elapsed_ms, operations, response_bytes, failed):
+        """Adds a call; response_bytes is None if its size was not
+        sampled."""
+        self.calls += 1
+        if failed:
+            self.errors += 1
+        self.latency[bisect.bisect_left(LATENCY_BUCKETS, elapsed_ms)] += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        for operation, count in operations.items():
+            self.operations[operation] += count
+        if response_bytes is not None:
+            self.sampled_responses += 1
+            self.response_bytes += response_bytes
+            self.max_response_bytes = max(self.max_response_bytes,
+                                          response_bytes)
+
+    def mean_response_bytes(self):
+        if not self.sampled_responses:
+            return 0.0
+        return float(self.response_bytes) / self.sampled_responses
+
+    def percentile(self, fraction):
+        """Returns the upper bound, in milliseconds, of the bucket holding
+        the call at fraction of the way through the sorted latencies, or
+        the slowest latency if that is lower."""
+        slowest = int(math.ceil(self.max_ms))
+        remaining = fraction * self.calls
+        for bound, count in zip(LATENCY_BUCKETS, self.latency):
+            remaining -= count
+            if remaining <= 0:
+                return min(bound, slowest)
+        return slowest
+
+    def to_form(self):
+        bounds = list(LATENCY_BUCKETS) + [None]
+        return MethodMetricsForm(
+            name=self.name,
+            calls=self.calls,
+            errors=self.errors,
+            mean_ms=self.total_ms / self.calls if self.calls else 0.0,
+            p50_ms=self.percentile(0.5),
+            p95_ms=self.percentile(0.95),
+            p99_ms=self.percentile(0.99),
+            max_ms=int(math.ceil(self.max_ms)),
+            latency=[LatencyBucketForm(upper_bound_ms=bound, count=count)
+                     for bound, count in zip(bounds, self.latency)],
+            gets=self.operations['get'],
+            puts=self.operations['put'],
+            deletes=self.operations['delete'],
+            queries=self.operations['query'],
+            mean_response_bytes=self.mean_response_bytes(),
+            max_response_bytes=self.max_response_bytes,
+            sampled_responses=self.sampled_responses)
+
+    def summary(self):
+        """Returns a one-line summary for the log."""
+        return ('{name}: calls={calls} errors={errors} p50={p50}ms '
+                'p95={p95}ms p99={p99}ms max={max}ms gets={get} puts={put} '
+                'deletes={delete} queries={query} '
+                'mean_bytes={bytes}').format(
+            name=self.name, calls=self.calls, errors=self.errors,
+            p50=self.percentile(0.5), p95=self.percentile(0.95),
+            p99=self.percentile(0.99), max=int(math.ceil(self.max_ms)),
+            bytes=int(round(self.mean_response_bytes())),
+            **self.operations)
+
+
+class Metrics(object):
+    """The MethodMetrics of every method called on this instance."""
+
+    def __init__(self, dump_interval=DUMP_INTERVAL):
+        self.dump_interval = dump_interval
+        self.started = time.time()
+        self._last_dump = self.started
+        self._lock = threading.Lock()
+        self._methods = {}
+
+    def record(self, name, elapsed_ms, operations, response_bytes, failed):
+        with self._lock:
+            method = self._methods.get(name)
+            if method is None:
+                method = self._methods[name] = MethodMetrics(name)
+            method.add(elapsed_ms, operations, response_bytes, failed)
+            now = time.time()
+            dump = now - self._last_dump >= self.dump_interval
+            if dump:
+                self._last_dump = now
+        if dump:
+            self.log()
+
+    def log(self):
+        """Logs a summary line per method."""
+        with self._lock:
+            lines = [self._methods[name].summary()
+                     for name in sorted(self._methods)]
+        logging.info('API metrics since %s:\n%s', time.strftime(
+            '%Y-%m-%d %H:%M:%S', time.gmtime(self.started)),
+            '\n'.join(lines))
+
+    def to_form(self):
+        with self._lock:
+            return MetricsForm(
+                since=time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                    time.gmtime(self.started)),
+                methods=[self._methods[name].to_form()
+                         for name in sorted(self._methods)])
+
+
+_metrics = Metrics()
+# The operation counts of the call in progress on each thread.
+_current = threading.local()
+
+
+def get_metrics():
+    """Returns this instance's Metrics."""
+    return _metrics
+
+
+def _count(operation, count):
+    operations = getattr(_current, 'operations', None)
+    if operations is not None:
+        operations[operation] += count
+
+
+storage.add_operation_listener(_count)
+
+
+def instrumented(method):
+    """Decorates an API method to record its metrics under its name."""
+    @functools.wraps(method)
+    def wrapper(service, request):
+        _current.operations = dict.fromkeys(OPERATIONS, 0)
+        started = time.time()
+        response = None
+        try:
+            response = method(service, request)
+            return response
+        finally:
+            elapsed_ms = (time.time() - started) * 1000
+            operations = _current.operations
+            _current.operations = None
+            response_bytes = None
+            if response is not None and \
+                    random.random() < RESPONSE_SAMPLE_RATE:
+                response_bytes = len(protojson.encode_message(response))
+            _metrics.record(method.__name__, elapsed_ms, operations,
+                            response_bytes, response is None)
+    return wrapper
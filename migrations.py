@@ -0,0 +1,160 @@
+import itertools
+import logging
+import time
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import game_history
+import leaderboard
+import storage
+from game import Game
+from user import User, UserName
+from user_stats import UserStats
+
+"""
+migrations.py - One-off tasks that rewrite every Game or User after a
+change of format.
+
+An admin's GET of a /tasks/ url queues the first task.  Each task reads
+BATCH_SIZE entities at a time with a cursor, writes each batch before
+reading the next, and once TASK_TIME_LIMIT seconds have passed queues a
+task for the rest and stops, as reminders.py does, so no request reaches
+its deadline however many entities there are.  Each batch is safe to
+write twice, so a task run again after a failure does no harm.
+"""
+
+BATCH_SIZE = 100
+TASK_TIME_LIMIT = 8 * 60
+
+
+def queue(url, **params):
+    """Queues the task at url, which resumes the migration from params."""
+    taskqueue.add(url=url, params=dict(
+        (name, value) for name, value in params.items()
+        if value is not None))
+
+
+def _pages(model, filters, cursor, deadline):
+    """Yields each page of the entities of model matching filters from
+    cursor, with the cursor of the next page, until the deadline passes.
+    The cursor is None with the last page."""
+    while True:
+        page, cursor, more = storage.query_page(
+            model, filters, page_size=BATCH_SIZE, cursor=cursor)
+        if not more:
+            yield page, None
+            return
+        yield page, cursor
+        if time.time() > deadline:
+            return
+
+
+def migrate_history(cursor, deadline):
+    """Converts every Game history stored as a pickled dict to the binary
+    log format in game_history.py.
+    Args:
+        cursor: The cursor of the first page of Games, or None.
+        deadline: The time.time() at which to stop.
+    Returns:
+        The cursor to resume from if the deadline passed, otherwise None.
+    """
+    migrated = 0
+    for games, next_cursor in _pages(Game, (), cursor, deadline):
+        legacy = [game for game in games
+                  if game_history.is_legacy(game.history)]
+        for game in legacy:
+            game.history = game_history.migrate(game.history)
+        storage.put_multi(legacy)
+        migrated += len(legacy)
+    logging.info('Migrated the history of %d games', migrated)
+    return next_cursor
+
+
+def rebuild_leaderboard(page, cursor, deadline):
+    """Adds every ranked User's high score to the copy of the leaderboard
+    that leaderboard.start_rebuild cleared, and replaces the leaderboard
+    with it after the last page.
+    Args:
+        page: The number of the page of Users at cursor.
+        cursor: The cursor of that page, or None for the first.
+        deadline: The time.time() at which to stop.
+    Returns:
+        The page number and cursor to resume from if the deadline passed,
+        otherwise None.
+    """
+    for users, next_cursor in _pages(User, (), cursor, deadline):
+        leaderboard.rebuild_page(
+            page, [(user.high_score, user.key) for user in users
+                   if user.is_ranked() and
+                   0 <= user.high_score <= leaderboard.MAX_SCORE])
+        page += 1
+        if next_cursor is None:
+            leaderboard.finish_rebuild()
+            logging.info('Rebuilt the leaderboard')
+            return None
+    return page, next_cursor
+
+
+def rebuild_user_stats(start, deadline):
+    """Recomputes the UserStats of every User with an id from start from
+    their finished games, which are read in order of user so that each
+    user's games arrive together.  Resumes from a User id rather than a
+    cursor so that no user's games are split between two tasks.
+    Args:
+        start: The User id to start from, or None for the first.
+        deadline: The time.time() at which to stop.
+    Returns:
+        The User id to resume from if the deadline passed, otherwise None.
+    """
+    filters = [('game_over', '==', True)]
+    if start is not None:
+        filters.append(('user', '>=', ndb.Key(User, start)))
+    games = storage.iterate(Game, filters, order='user',
+                            batch_size=BATCH_SIZE)
+    batch = []
+    for user_key, user_games in itertools.groupby(
+            games, key=lambda game: game.user):
+        if time.time() > deadline:
+            storage.put_multi(batch)
+            return user_key.id()
+        stats = UserStats.for_user(user_key)
+        for game in user_games:
+            # The background task adds games whose score is pending.
+            if not game.score_pending:
+                game.ensure_totals()
+                stats.add_game(game)
+        batch.append(stats)
+        if len(batch) == BATCH_SIZE:
+            storage.put_multi(batch)
+            batch = []
+    storage.put_multi(batch)
+    logging.info('Rebuilt the statistics of every user')
+    return None
+
+
+def index_user_names(cursor, deadline):
+    """Creates the UserName entity of every User created before user names
+    were indexed.  The first User with a name keeps it.
+    Args:
+        cursor: The cursor of the first page of Users, or None.
+        deadline: The time.time() at which to stop.
+    Returns:
+        The cursor to resume from if the deadline passed, otherwise None.
+    """
+    indexed = 0
+    for users, next_cursor in _pages(User, (), cursor, deadline):
+        batch = [user for user in users if user.name]
+        name_keys = [UserName.key_for(user.name) for user in batch]
+        claimed = {}
+        for user, name_key, index in zip(
+                batch, name_keys, storage.get_multi(name_keys)):
+            if index and index.user != user.key:
+                logging.warning('User %s has the name %r of User %s',
+                                user.key.id(), user.name, index.user.id())
+            elif not index and name_key not in claimed:
+                claimed[name_key] = UserName(key=name_key, user=user.key)
+        storage.put_multi(claimed.values())
+        indexed += len(claimed)
+    logging.info('Indexed the names of %d users', indexed)
+    return next_cursor
@@ -0,0 +1,42 @@
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+
+import scoresheet
+
+"""
+properties.py - Datastore properties for the packed formats in scoresheet.py.
+
+Both properties are stored as blobs, like the PickleProperty they replace,
+so entities written before the packed formats still load and are rewritten
+in the packed format on their next put.
+"""
+
+
+class CategoryScoresProperty(ndb.BlobProperty):
+    """Stores a scoresheet.CategoryScores in 16 bytes."""
+
+    def _validate(self, value):
+        if not isinstance(value, scoresheet.CategoryScores):
+            raise datastore_errors.BadValueError(
+                'Expected CategoryScores, got {!r}'.format(value))
+
+    def _to_base_type(self, value):
+        return value.pack()
+
+    def _from_base_type(self, value):
+        return scoresheet.CategoryScores.unpack(value)
+
+
+class DiceProperty(ndb.BlobProperty):
+    """Stores a list of five dice (or no dice) in at most 3 bytes."""
+
+    def _validate(self, value):
+        if not isinstance(value, list):
+            raise datastore_errors.BadValueError(
+                'Expected a list of dice, got {!r}'.format(value))
+
+    def _to_base_type(self, value):
+        return scoresheet.pack_dice(value)
+
+    def _from_base_type(self, value):
+        return scoresheet.unpack_dice(value)
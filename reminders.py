@@ -0,0 +1,113 @@
+import itertools
+import time
+
+from google.appengine.api import app_identity
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import mailer
+import storage
+from game import Game
+from user import User
+
+"""
+reminders.py - Hourly reminder emails to users with games in progress.
+
+The cron request only splits the ids of the Users into NUM_SHARDS ranges
+and queues a task for each.  A task reads the active games of the users in
+its range with one projection query ordered by user, so each user's games
+arrive together, loads those users MAIL_BATCH_SIZE at a time and hands
+their emails to the mailer as one batch.  Users without active games are
+never read.  A task still running after TASK_TIME_LIMIT seconds queues a
+task for the rest of its range and stops, so no request reaches its
+deadline however many users there are.
+"""
+
+NUM_SHARDS = 20
+MAIL_BATCH_SIZE = 100
+TASK_TIME_LIMIT = 8 * 60
+TASK_URL = '/tasks/send_reminders'
+
+SUBJECT = 'This is a reminder!'
+
+
+def shard_ranges(num_shards=NUM_SHARDS):
+    """Returns up to num_shards [start, end) ranges covering the ids of
+    every User."""
+    first = storage.first(User, order='key')
+    if first is None:
+        return []
+    last = storage.first(User, order='-key')
+    low, high = first.key.id(), last.key.id() + 1
+    size = max(1, (high - low + num_shards - 1) // num_shards)
+    return [(start, min(start + size, high))
+            for start in range(low, high, size)]
+
+
+def queue_range(start, end):
+    taskqueue.add(url=TASK_URL, params={'start': start, 'end': end})
+
+
+def queue_shards(num_shards=NUM_SHARDS):
+    """Queues a task for each range of User ids and returns the number of
+    tasks queued."""
+    tasks = [taskqueue.Task(url=TASK_URL, params={'start': start, 'end': end})
+             for start, end in shard_ranges(num_shards)]
+    queue = taskqueue.Queue()
+    for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+        queue.add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+    return len(tasks)
+
+
+def active_games_by_user(start, end):
+    """Yields the key of each User with an id in [start, end) who has
+    active games, with the list of their keys, in order of User key."""
+    games = storage.iterate(Game, [('game_over', '==', False),
+                                   ('user', '>=', ndb.Key(User, start)),
+                                   ('user', '<', ndb.Key(User, end))],
+                            order='user', projection=['user'])
+    for user_key, user_games in itertools.groupby(games,
+                                                  key=lambda g: g.user):
+        yield user_key, [game.key for game in user_games]
+
+
+def reminder_body(user, game_keys):
+    return 'Hello {}, you have {} games in progress. Their keys are: {}'.\
+        format(user.name, len(game_keys),
+               ', '.join(key.urlsafe() for key in game_keys))
+
+
+def _send(batch):
+    """Emails each user with an email in a list of (User key, game keys)."""
+    if not batch:
+        return
+    sender = 'noreply@{}.appspotmail.com'.format(
+        app_identity.get_application_id())
+    users = storage.get_multi([user_key for user_key, game_keys in batch])
+    mailer.send_batch([
+        mailer.Email(sender, user.email, SUBJECT,
+                     reminder_body(user, game_keys))
+        for user, (user_key, game_keys) in zip(users, batch)
+        if user and user.email])
+
+
+def send_reminders(start, end, deadline):
+    """Sends a reminder to every User with an id in [start, end) who has an
+    email and active games.
+    Args:
+        start, end: The range of User ids.
+        deadline: The time.time() at which to stop.
+    Returns:
+        The User id to resume from if the deadline passed, otherwise None.
+    """
+    batch = []
+    for user_key, game_keys in active_games_by_user(start, end):
+        if time.time() > deadline:
+            _send(batch)
+            return user_key.id()
+        batch.append((user_key, game_keys))
+        if len(batch) == MAIL_BATCH_SIZE:
+            _send(batch)
+            batch = []
+    _send(batch)
+    return None
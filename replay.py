@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+
+import argparse
+import itertools
+import multiprocessing
+import time
+
+import game_history
+import scoring
+from game_history import RollEvent
+from scoresheet import CategoryScores
+
+"""
+replay.py - Rebuilds and checks games from their stored histories.
+
+replay(log) yields the state of the game after every event of a
+game_history log: the dice, the roll count, the category scores and the
+bonuses.  Each step is checked against the rules as it is applied, and the
+first one that breaks them raises a ReplayError naming the event.
+final_state(log) only returns the last state, which is faster.
+
+replay_many replays (id, log) pairs across a process pool, reading its
+input a window at a time so that the histories can be streamed from the
+datastore.  Run as a script, it replays every stored Game and reports the
+ones whose history breaks the rules or disagrees with the stored totals:
+
+    YAHTZEE_STORAGE=sqlite:games.db python replay.py --processes 8
+
+This module does not use the datastore itself, so worker processes need
+only the modules imported here.
+"""
+
+# Number of games sent to a worker at a time, and number of games read
+# ahead of the workers.
+CHUNK_SIZE = 500
+WINDOW_SIZE = 50 * CHUNK_SIZE
+
+
+class ReplayError(ValueError):
+    """Raised for a history that breaks the rules.
+    Attributes:
+        index: The position of the offending event in the history.
+        event: The offending RollEvent or ScoreEvent.
+    """
+
+    def __init__(self, index, event, message):
+        super(ReplayError, self).__init__(
+            'Event {} {}: {}'.format(index, event, message))
+        self.index = index
+        self.event = event
+
+
+class GameState(object):
+    """The state of a game between two events."""
+
+    __slots__ = ('turn', 'roll_count', 'dice', 'category_scores',
+                 'upper_bonus', 'yahtzee_bonus_count', 'total_score')
+
+    def __init__(self):
+        self.turn = 0
+        self.roll_count = 0
+        self.dice = []
+        self.category_scores = CategoryScores()
+        self.upper_bonus = 0
+        self.yahtzee_bonus_count = 0
+        self.total_score = 0
+
+    def copy(self):
+        state = GameState()
+        state.turn = self.turn
+        state.roll_count = self.roll_count
+        state.dice = list(self.dice)
+        state.category_scores = CategoryScores(
+            self.category_scores.filled, self.category_scores.scores)
+        state.upper_bonus = self.upper_bonus
+        state.yahtzee_bonus_count = self.yahtzee_bonus_count
+        state.total_score = self.total_score
+        return state
+
+    def is_over(self):
+        return self.category_scores.is_full()
+
+    def to_dict(self):
+        return {'turn': self.turn,
+                'roll_count': self.roll_count,
+                'dice': list(self.dice),
+                'category_scores': self.category_scores.to_dict(),
+                'upper_bonus': self.upper_bonus,
+                'yahtzee_bonus_count': self.yahtzee_bonus_count,
+                'total_score': self.total_score}
+
+    def __repr__(self):
+        return 'GameState({!r})'.format(self.to_dict())
+
+
+def _roll(state, index, event):
+    if event.roll_count == 1:
+        if state.roll_count:
+            raise ReplayError(index, event, 'turn {} was not scored'.format(
+                state.turn))
+        if event.turn != state.turn + 1:
+            raise ReplayError(index, event, 'expected turn {}'.format(
+                state.turn + 1))
+    elif (event.turn != state.turn or
+          event.roll_count != state.roll_count + 1 or
+          event.roll_count > 3):
+        raise ReplayError(index, event, 'expected roll {} of turn {}'.format(
+            state.roll_count + 1, state.turn))
+    # Packed dice are 3 bits each, so 0 and 7 are the only invalid values.
+    if 0 in event.dice or 7 in event.dice:
+        raise ReplayError(index, event, 'invalid dice')
+
+    state.turn = event.turn
+    state.roll_count = event.roll_count
+    state.dice = event.dice
+
+
+def _score(state, index, event):
+    if event.turn != state.turn or not state.roll_count:
+        raise ReplayError(index, event, 'the dice were not rolled')
+    category = event.category
+    if category >= scoring.NUM_CATEGORIES:
+        raise ReplayError(index, event, 'invalid category')
+    if state.category_scores.is_filled(category):
+        raise ReplayError(index, event, '{} already contains a score'.format(
+            scoring.CATEGORY_NAMES[category]))
+    expected = scoring.SCORES[scoring.hand_index(state.dice)][category]
+    if event.score != expected:
+        raise ReplayError(index, event, '{} scores {} for {}'.format(
+            scoring.CATEGORY_NAMES[category], expected, state.dice))
+
+    scores = state.category_scores
+    if scoring.earns_yahtzee_bonus(scores, state.dice):
+        state.yahtzee_bonus_count += 1
+        state.total_score += scoring.YAHTZEE_BONUS
+    scores.set(category, expected)
+    state.total_score += expected
+    if (not state.upper_bonus and category in scoring.UPPER_SECTION and
+            scores.upper_section_total() >= scoring.UPPER_BONUS_THRESHOLD):
+        state.upper_bonus = scoring.UPPER_BONUS
+        state.total_score += scoring.UPPER_BONUS
+
+    state.roll_count = 0
+    state.dice = []
+
+
+def _apply(state, index, event):
+    if state.is_over():
+        raise ReplayError(index, event, 'the game is over')
+    if isinstance(event, RollEvent):
+        _roll(state, index, event)
+    else:
+        _score(state, index, event)
+
+
+def replay(log):
+    """Yields each event of a history log with a copy of the GameState
+    after it.  Raises ReplayError at the first event that breaks the
+    rules."""
+    state = GameState()
+    for index, event in enumerate(game_history.iter_events(log)):
+        _apply(state, index, event)
+        yield event, state.copy()
+
+
+def final_state(log):
+    """Returns the GameState after the last event of a history log.
+    Raises ReplayError if any event breaks the rules."""
+    state = GameState()
+    for index, event in enumerate(game_history.iter_events(log)):
+        _apply(state, index, event)
+    return state
+
+
+# Batches
+
+def _replay_chunk(chunk):
+    """Worker: returns (id, GameState or None, error message or None) for
+    each (id, log) in chunk."""
+    results = []
+    for game_id, log in chunk:
+        try:
+            results.append((game_id, final_state(log), None))
+        except ReplayError as e:
+            results.append((game_id, None, str(e)))
+    return results
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def replay_many(histories, processes=None):
+    """Replays (id, log) pairs across a process pool.
+    Args:
+        histories: An iterable of (id, history log) pairs, read
+            WINDOW_SIZE at a time.
+        processes: The size of the pool (defaults to the number of CPUs).
+    Yields:
+        (id, GameState, None) for each valid history and
+        (id, None, error message) for each invalid one, in input order.
+    """
+    pool = multiprocessing.Pool(processes)
+    try:
+        for window in _chunks(histories, WINDOW_SIZE):
+            for results in pool.imap(_replay_chunk,
+                                     _chunks(window, CHUNK_SIZE)):
+                for result in results:
+                    yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def stored_mismatches(game, state):
+    """Returns a list describing each way the stored Game differs from the
+    GameState replayed from its history."""
+    mismatches = []
+    if game.category_scores != state.category_scores:
+        mismatches.append('category_scores {!r} != {!r}'.format(
+            game.category_scores, state.category_scores))
+    if game.yahtzee_bonus_count != state.yahtzee_bonus_count:
+        mismatches.append('yahtzee_bonus_count {} != {}'.format(
+            game.yahtzee_bonus_count, state.yahtzee_bonus_count))
+    if game.total_score is not None and \
+            game.total_score != state.total_score:
+        mismatches.append('total_score {} != {}'.format(
+            game.total_score, state.total_score))
+    if game.game_over and game.final_score != state.total_score:
+        mismatches.append('final_score {} != {}'.format(
+            game.final_score, state.total_score))
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replays the history of every stored game.')
+    parser.add_argument('--processes', type=int)
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+
+    # Imported here so that worker processes and the replay functions do
+    # not need the App Engine SDK.
+    import storage
+    from game import Game
+
+    games = {}
+
+    def histories():
+        for game in storage.iterate(Game, batch_size=args.batch_size):
+            games[game.key.urlsafe()] = game
+            yield game.key.urlsafe(), game.history
+
+    replayed = failed = 0
+    started = time.time()
+    for key, state, error in replay_many(histories(), args.processes):
+        game = games.pop(key)
+        replayed += 1
+        if error is None:
+            errors = stored_mismatches(game, state)
+        else:
+            errors = [error]
+        if errors:
+            failed += 1
+            print('{}: {}'.format(key, '; '.join(errors)))
+    elapsed = time.time() - started
+
+    print('{} games replayed, {} with errors, {:.0f} games/sec'.format(
+        replayed, failed, replayed / max(elapsed, 1e-9)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+from itertools import combinations, combinations_with_replacement
+from math import factorial
+
+import scoring
+
+"""
+rerolls.py - Probabilities of the hands reached by rerolling dice.
+
+A reroll keeps a sub-multiset of the current dice and rolls the rest.  There
+are 462 possible multisets of kept dice (keeping nothing through keeping all
+five), and from each one only the sorted hands in scoring.HANDS can result.
+The probability of every (kept dice, resulting hand) pair is computed once at
+import time so that nothing has to enumerate the 7776 ordered outcomes of a
+roll at request time.
+"""
+
+# Every multiset of kept dice, from keeping nothing to keeping all five.
+KEEPS = tuple(keep for n in range(6)
+              for keep in combinations_with_replacement(range(1, 7), n))
+KEEP_INDEX = dict((keep, i) for i, keep in enumerate(KEEPS))
+
+# Index in KEEPS of keeping no dice, i.e. the first roll of a turn.
+ROLL_ALL = KEEP_INDEX[()]
+
+
+def _probability(rolled):
+    """Returns the probability of rolling exactly the given multiset."""
+    ways = factorial(len(rolled))
+    for value in set(rolled):
+        ways //= factorial(rolled.count(value))
+    return float(ways) / 6 ** len(rolled)
+
+
+def _transitions(keep):
+    """Returns (hand index, probability) pairs for rerolling around keep."""
+    return tuple(
+        (scoring.HAND_INDEX[tuple(sorted(keep + rolled))], _probability(rolled))
+        for rolled in combinations_with_replacement(range(1, 7), 5 - len(keep)))
+
+
+def _sub_keeps(hand):
+    """Returns the index of every distinct multiset of dice in hand."""
+    return tuple(sorted(set(KEEP_INDEX[keep] for n in range(6)
+                            for keep in combinations(hand, n))))
+
+
+# TRANSITIONS[k] lists the hands reachable by rerolling around KEEPS[k].
+TRANSITIONS = tuple(_transitions(keep) for keep in KEEPS)
+
+# HAND_KEEPS[h] lists the KEEPS that can be held from scoring.HANDS[h].
+HAND_KEEPS = tuple(_sub_keeps(hand) for hand in scoring.HANDS)
+
+
+def expected_values(hand_values):
+    """Returns the expected value of rerolling around each of the KEEPS,
+    given the value of ending up with each hand in scoring.HANDS."""
+    return [sum(p * hand_values[h] for h, p in transitions)
+            for transitions in TRANSITIONS]
+
+
+def keepers_mask(dice, keep):
+    """Returns the keepers list for roll_again (1 to keep a die, 0 to
+    reroll it) that holds the multiset keep out of dice."""
+    remaining = list(keep)
+    mask = []
+    for d in dice:
+        if d in remaining:
+            remaining.remove(d)
+            mask.append(1)
+        else:
+            mask.append(0)
+    return mask
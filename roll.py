@@ -1,13 +1,16 @@
-import random
 from datetime import date
 from protorpc import messages
 from google.appengine.ext import ndb
 
+import game_history
+import storage
+from properties import DiceProperty
+
 class Roll(ndb.Model):
     """Roll object """
     user = ndb.KeyProperty(required=True, kind='User')
     game = ndb.KeyProperty(required=True, kind='Game')
-    dice = ndb.PickleProperty(required=True)
+    dice = DiceProperty(required=True)
     count = ndb.IntegerProperty(required=True, default=0)
     isScored = ndb.BooleanProperty(required=True, default=False)
 
@@ -16,44 +19,37 @@ class Roll(ndb.Model):
         """Creates a new roll for a user"""
         roll = Roll(user=user,
                     game=game)
+        game = storage.get(game)
 
-        roll.dice = []
-        for i in range(5):
-            value = random.choice(range(1, 7))
-            roll.dice.append(value)
-            print value
+        roll.dice = game.draw_dice(5)
 
         roll.count = 1
-        roll.put()
+        storage.commit([roll, game])
         return roll
 
     def reroll(self, keepers):
         """Rerolls the dice but keeps dice listed in keepers.  
         Keepers array contains 0 or 1 (replace, keep) for each die index."""
-        print 'keepers', keepers
-        print 'current dice', self.dice
 
+        game = storage.get(self.game)
+        rerolled = iter(game.draw_dice(keepers[:5].count(0)))
         for i in range(5):
             if keepers[i] == 0:
-                value = random.choice(range(1, 7))
-                self.dice[i] = value
-                print value
+                self.dice[i] = next(rerolled)
 
         self.count += 1
-        self.put()
 
-        game = self.game.get()
         # Create entry for history.
-        entry = (self.count, self.dice)
-        game.history.append(entry)
-        # Save the game history.
-        game.put()
+        game.update_history(game_history.encode_roll(
+            game.turn_count, self.count, self.dice))
+        # Save the roll and the game history.
+        storage.commit([self, game])
 
         return self.to_form()
     
     def to_form(self):
         return RollResultForm(urlsafe_key=self.key.urlsafe(),
-                              user_name=self.user.get().name,
+                              user_name=storage.get(self.user).name,
                               dice=self.dice,
                               count=self.count,
                               isScored=self.isScored
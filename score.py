@@ -2,6 +2,8 @@ from datetime import date
 from protorpc import messages
 from google.appengine.ext import ndb
 
+import storage
+
 """
 score.py - This file contains the class definitions for the Datastore
 entities used by the game.
@@ -15,7 +17,7 @@ class Score(ndb.Model):
     score = ndb.IntegerProperty(required=True)    
 
     def to_form(self):
-        return ScoreForm(user_name=self.user.get().name,
+        return ScoreForm(user_name=storage.get(self.user).name,
                          date=str(self.date), 
                          score=self.score)
 
@@ -2,6 +2,11 @@ import endpoints
 from protorpc import messages
 from google.appengine.ext import ndb
 
+import scoring
+import storage
+from properties import CategoryScoresProperty
+from scoresheet import CategoryScores
+
 
 class CategoryType(messages.Enum):
     """CategoryType -- enumeration value"""
@@ -25,7 +30,10 @@ class Scorecard(ndb.Model):
     game = ndb.KeyProperty(required=True, kind='Game')
     upper_section_total = ndb.IntegerProperty(default=0)
     bonus_points = ndb.IntegerProperty(default=0)
-    category_scores = ndb.PickleProperty(required=True)
+    category_scores = CategoryScoresProperty(required=True)
+    # Indexed 13-bit mask of the filled categories.
+    filled_categories = ndb.ComputedProperty(
+        lambda self: self.category_scores.filled)
     final_score = ndb.IntegerProperty(default=0)
     yahzee_bonus_count = ndb.IntegerProperty(default=0)
 
@@ -33,133 +41,16 @@ class Scorecard(ndb.Model):
     def new_scorecard(cls, game):
         """Returns a new (empty) score card for the game"""
         score_card = Scorecard(game=game)
-        scores = {}
-        scores['ACES'] = -1
-        scores['TWOS'] = -1
-        scores['THREES'] = -1
-        scores['FOURS'] = -1
-        scores['FIVES'] = -1
-        scores['SIXES'] = -1
-        scores['THREE_OF_A_KIND'] = -1
-        scores['FOUR_OF_A_KIND'] = -1
-        scores['FULL_HOUSE'] = -1
-        scores['SMALL_STRAIGHT'] = -1
-        scores['LARGE_STRAIGHT'] = -1
-        scores['YAHTZEE'] = -1
-        scores['CHANCE'] = -1
-        score_card.category_scores = scores
-        score_card.put()
+        score_card.category_scores = CategoryScores()
+        storage.put(score_card)
         return score_card
 
     def calculate_score_for_category(self, dice, category):
         """Returns the score for the given dice in the given category."""
+        score = scoring.score(dice, category)
 
-        # Maintain a frequency table of dice values
-        frequencies = {}
-        for d in dice:
-            if d in frequencies:
-                count = frequencies[d]
-                count += 1
-                frequencies[d] = count
-            else:
-                frequencies[d] = 1
-
-        score = 0
-        if (category is CategoryType.ACES):
-            # Total of ones only
-            score = self.totalOf(1, dice)
-
-        elif (category is CategoryType.TWOS):
-            # Total of twos only
-            score = self.totalOf(2, dice)
-
-        elif (category is CategoryType.THREES):
-            # Total of threes only
-            score = self.totalOf(3, dice)
-
-        elif (category is CategoryType.FOURS):
-            # Total of fours only
-            score = self.totalOf(4, dice)
-
-        elif (category is CategoryType.FIVES):
-            # Total of fives only
-            score = self.totalOf(5, dice)
-
-        elif (category is CategoryType.SIXES):
-            # Total of sixes only
-            score = self.totalOf(6, dice)
-
-        elif (category is CategoryType.THREE_OF_A_KIND):
-            # If there are three of a kind, the score is equal to the sum of
-            # all five dice.
-            found = False
-            for d in frequencies:
-                if frequencies[d] >= 3:
-                    found = True
-                    break
-            if found:
-                score = sum(dice)
-
-        elif (category is CategoryType.FOUR_OF_A_KIND):
-            # If there are four of a kind, the score is equal to the sum of all
-            # five dice.
-            found = False
-            for d in frequencies:
-                if frequencies[d] >= 4:
-                    found = True
-                    break
-            if found:
-                score = sum(dice)
-
-        elif category is CategoryType.FULL_HOUSE:
-            # A full house is worth 25 points.
-            if 2 in frequencies.values() and 3 in frequencies.values():
-                score = 25
-
-        elif category is CategoryType.SMALL_STRAIGHT:
-            # A small straight is worth 30 points.
-            if {1, 2, 3, 4} <= set(dice):
-                score = 30
-            elif {2, 3, 4, 5} <= set(dice):
-                score = 30
-            elif {3, 4, 5, 6} <= set(dice):
-                score = 30
-
-        elif category is CategoryType.LARGE_STRAIGHT:
-            # A large straight is worth 40 points.
-            if {1, 2, 3, 4, 5} <= set(dice):
-                score = 40
-            elif {2, 3, 4, 5, 6} <= set(dice):
-                score = 40
-
-        elif category is CategoryType.YAHTZEE:
-            # Five of a kind.  A YAHTZEE is worth 50 points.
-
-            # Check to make sure all dice are the same.
-            is_Yahztee = (5 in frequencies.values())
-
-            """If the user rolls YAHTZEE and has already filled in the 
-            YAHZTEE box with 50, they get a 100-point bonus.
-            If they have already filled in the YAHTZEE box with 0, 
-            they do not get a bonus."""
-
-            # Has a score already been entered for the YAHTZEE category?
-            current_score = self.category_scores[str(category)]
-            if current_score == -1:
-                # No score has been entered yet, so score normally.
-                if is_Yahztee:
-                    score = 50
-                else:
-                    score = 0
-
-            elif current_score == 50:
-                """A score of 50 has already been entered, 
-                so increase the YAHTZEE bonus conut."""
-                self.yahzee_bonus_count += 1
-
-        elif category is CategoryType.CHANCE:
-            # Sum of all five dice.
-            score = sum(dice)
+        if scoring.earns_yahtzee_bonus(self.category_scores, dice):
+            self.yahzee_bonus_count += 1
 
         return score
 
@@ -184,31 +75,13 @@ class Scorecard(ndb.Model):
         # self.put()
 
     def calculateUpperSectionTotal(self):
-        """Returns total of scores in upper section.  
-        Ignores values less than zero."""
-
-        total = 0
-        if self.category_scores['ACES'] != -1:
-            total += self.category_scores['ACES']
-        if self.category_scores['TWOS'] != -1:
-            total += self.category_scores['TWOS']
-        if self.category_scores['THREES'] != -1:
-            total += self.category_scores['THREES']
-        if self.category_scores['FOURS'] != -1:
-            total += self.category_scores['FOURS']
-        if self.category_scores['FIVES'] != -1:
-            total += self.category_scores['FIVES']
-        if self.category_scores['SIXES'] != -1:
-            total += self.category_scores['SIXES']
-
-        return total
+        """Returns total of scores in upper section.
+        Ignores categories not yet scored."""
+        return self.category_scores.upper_section_total()
 
     def check_full(self):
         """Returns whether or not the scorecard has been completely filled in."""
-        for key in self.category_scores:
-            if self.category_scores[key] == -1:
-                return False
-        return True
+        return self.category_scores.is_full()
 
     def calculate_final_score(self):
         """Returns the overall final score."""
@@ -219,55 +92,69 @@ class Scorecard(ndb.Model):
         if self.upper_section_total >= 63:
             self.bonus_points = 35
 
-        total = 0
-        for key in self.category_scores:
-            total += self.category_scores[key]
-
+        total = self.category_scores.total()
         total += self.bonus_points
 
         # Add 100 points for each YAHTZEE bonus.
         total += 100 * self.yahzee_bonus_count
 
+        # The caller stores the scorecard, with the rest of the turn.
         self.final_score = total
 
-        # save the scorecard
-        self.put()
-
         # return the total
         return total
 
-    def totalOf(self, value, dice):
-        """
-        Returns the sum of dice of a given value.
-        For example, if dice = [1,3,5,3,4] and value = 3, 
-        then 6 (3+3) is returned.
-        """
-        score = 0
-        for d in dice:
-            if d is value:
-                score += d
-        return score
-
     def to_form(self):
         return ScorecardForm(            
             upper_section_total=self.upper_section_total,
             bonus_points=self.bonus_points,
-            category_scores=str(self.category_scores),
+            category_scores=category_score_forms(self.category_scores),
+            open_categories=open_category_types(self.category_scores),
             yahzee_bonus_count=self.yahzee_bonus_count,
             final_score = self.final_score,
-            game_over = self.game.get().game_over
+            game_over = storage.get(self.game).game_over
         )
 
 
 
+# The CategoryType of each category index, looked up rather than created
+# for every form.
+_CATEGORY_TYPES = [CategoryType(c + 1) for c in range(scoring.NUM_CATEGORIES)]
+
+
+def category_score_forms(category_scores):
+    """Returns a CategoryScoreForm for each category of a CategoryScores."""
+    return [CategoryScoreForm(category_type=category_type,
+                              score=category_scores.scores[c],
+                              filled=True)
+            if category_scores.is_filled(c) else
+            CategoryScoreForm(category_type=category_type, filled=False)
+            for c, category_type in enumerate(_CATEGORY_TYPES)]
+
+
+def open_category_types(category_scores):
+    """Returns the CategoryType of each category not yet scored."""
+    return [_CATEGORY_TYPES[c] for c in category_scores.open_categories()]
+
+
+class CategoryScoreForm(messages.Message):
+    """CategoryScoreForm for one category; score is only set once the
+    category is filled"""
+    category_type = messages.EnumField('CategoryType', 1, required=True)
+    score = messages.IntegerField(2)
+    filled = messages.BooleanField(3, required=True)
+
+
 class ScorecardForm(messages.Message):
     """Used to return the user's scorecard"""    
     upper_section_total = messages.IntegerField(1, required=True)
     bonus_points = messages.IntegerField(2, required=True)
-    category_scores = messages.StringField(3, required=True)
+    category_scores = messages.MessageField(CategoryScoreForm, 3,
+                                            repeated=True)
     yahzee_bonus_count = messages.IntegerField(4, required=True)
     final_score = messages.IntegerField(5, required=True)
     game_over = messages.BooleanField(6, required=True)
+    open_categories = messages.EnumField('CategoryType', 7, repeated=True)
 
 
 class ScoreTurnForm(messages.Message):
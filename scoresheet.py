@@ -0,0 +1,137 @@
+import pickle
+import struct
+
+import scoring
+
+"""
+scoresheet.py - Packed representations of category scores and dice.
+
+CategoryScores keeps a 13-bit mask of the filled categories and a fixed
+array of one byte per category, indexed like scoring.SCORES, so "is the
+scorecard full", "which categories are open" and the upper section total
+never walk a dict keyed by category name.  Packed, a scorecard is 16 bytes
+and five dice are 3 bytes: a version byte followed by the data.
+
+Values written before these formats are pickled; they are recognised by
+their first byte and converted when they are unpacked.
+"""
+
+VERSION = 1
+_VERSION_BYTE = struct.pack('B', VERSION)
+
+ALL_FILLED = (1 << scoring.NUM_CATEGORIES) - 1
+
+_SCORES = struct.Struct('>BH13s')
+_DICE = struct.Struct('>BH')
+
+
+def _is_legacy(data):
+    return bool(data) and data[:1] != _VERSION_BYTE
+
+
+class CategoryScores(object):
+    """The score entered in each of the 13 categories."""
+
+    __slots__ = ('filled', 'scores')
+
+    def __init__(self, filled=0, scores=None):
+        self.filled = filled
+        self.scores = bytearray(scores or scoring.NUM_CATEGORIES)
+
+    def is_filled(self, category):
+        """Returns whether the category at index category has a score."""
+        return bool(self.filled & (1 << category))
+
+    def get(self, category):
+        """Returns the score of the category at index category, or -1 if it
+        has not been scored."""
+        return self.scores[category] if self.is_filled(category) else -1
+
+    def set(self, category, score):
+        """Enters score in the category at index category."""
+        self.filled |= 1 << category
+        self.scores[category] = score
+
+    def is_full(self):
+        return self.filled == ALL_FILLED
+
+    def open_categories(self):
+        """Returns the index of every category not yet scored."""
+        return [c for c in range(scoring.NUM_CATEGORIES)
+                if not self.filled & (1 << c)]
+
+    def upper_section_total(self):
+        """Returns the total of the scores in the upper section."""
+        return sum(self.scores[:len(scoring.UPPER_SECTION)])
+
+    def total(self):
+        """Returns the total of every score entered, without bonuses."""
+        return sum(self.scores)
+
+    def to_dict(self):
+        """Returns the scores keyed by category name, with -1 for categories
+        not yet scored."""
+        return dict((name, self.get(c))
+                    for c, name in enumerate(scoring.CATEGORY_NAMES))
+
+    @classmethod
+    def from_dict(cls, category_scores):
+        """Returns the CategoryScores for a dict keyed by category name."""
+        scores = cls()
+        for c, name in enumerate(scoring.CATEGORY_NAMES):
+            if category_scores[name] != -1:
+                scores.set(c, category_scores[name])
+        return scores
+
+    def pack(self):
+        return _SCORES.pack(VERSION, self.filled, bytes(self.scores))
+
+    @classmethod
+    def unpack(cls, data):
+        """Returns the CategoryScores for packed data or a legacy pickled
+        dict."""
+        if _is_legacy(data):
+            return cls.from_dict(pickle.loads(data))
+        version, filled, scores = _SCORES.unpack(data)
+        return cls(filled, scores)
+
+    def __eq__(self, other):
+        return (isinstance(other, CategoryScores) and
+                self.filled == other.filled and self.scores == other.scores)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'CategoryScores({!r})'.format(self.to_dict())
+
+
+def dice_to_bits(dice):
+    """Returns five dice packed 3 bits each into an integer."""
+    packed = 0
+    for i, d in enumerate(dice):
+        packed |= d << (3 * i)
+    return packed
+
+
+def bits_to_dice(packed):
+    """Returns the list of dice packed by dice_to_bits."""
+    return [(packed >> (3 * i)) & 7 for i in range(5)]
+
+
+def pack_dice(dice):
+    """Returns the packed dice, or just the version byte if the dice have
+    not been rolled."""
+    if not dice:
+        return _VERSION_BYTE
+    return _DICE.pack(VERSION, dice_to_bits(dice))
+
+
+def unpack_dice(data):
+    """Returns the list of dice for packed data or a legacy pickled list."""
+    if _is_legacy(data):
+        return list(pickle.loads(data))
+    if len(data) < _DICE.size:
+        return []
+    version, packed = _DICE.unpack(data)
+    return bits_to_dice(packed)
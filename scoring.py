@@ -0,0 +1,147 @@
+from itertools import combinations_with_replacement
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+"""
+scoring.py - Table-driven scoring for every dice hand in every category.
+
+There are only 252 distinct hands of five dice once the order of the dice is
+ignored, so the score of each hand in each of the 13 categories is computed
+once at import time.  Scoring a roll is then a single lookup by the hand's
+canonical index.
+"""
+
+NUM_CATEGORIES = 13
+
+# Column of each category in a row of SCORES (CategoryType.number - 1).
+ACES, TWOS, THREES, FOURS, FIVES, SIXES, THREE_OF_A_KIND, FOUR_OF_A_KIND, \
+    FULL_HOUSE, SMALL_STRAIGHT, LARGE_STRAIGHT, YAHTZEE, CHANCE = \
+    range(NUM_CATEGORIES)
+
+UPPER_SECTION = (ACES, TWOS, THREES, FOURS, FIVES, SIXES)
+
+# A total of 63 or more in the upper section earns a 35-point bonus, and
+# every YAHTZEE rolled after scoring 50 in the YAHTZEE box earns 100 points.
+UPPER_BONUS_THRESHOLD = 63
+UPPER_BONUS = 35
+YAHTZEE_BONUS = 100
+
+# Keys of category_scores, ordered by CategoryType number.
+CATEGORY_NAMES = ('ACES', 'TWOS', 'THREES', 'FOURS', 'FIVES', 'SIXES',
+                  'THREE_OF_A_KIND', 'FOUR_OF_A_KIND', 'FULL_HOUSE',
+                  'SMALL_STRAIGHT', 'LARGE_STRAIGHT', 'YAHTZEE', 'CHANCE')
+
+SMALL_STRAIGHTS = ({1, 2, 3, 4}, {2, 3, 4, 5}, {3, 4, 5, 6})
+LARGE_STRAIGHTS = ({1, 2, 3, 4, 5}, {2, 3, 4, 5, 6})
+
+
+def _score_hand(hand):
+    """Returns a tuple with the score of the hand in each category."""
+    counts = [hand.count(value) for value in range(1, 7)]
+    most = max(counts)
+    total = sum(hand)
+    faces = set(hand)
+
+    scores = [counts[value - 1] * value for value in range(1, 7)]
+    scores.append(total if most >= 3 else 0)
+    scores.append(total if most >= 4 else 0)
+    scores.append(25 if 2 in counts and 3 in counts else 0)
+    scores.append(30 if any(s <= faces for s in SMALL_STRAIGHTS) else 0)
+    scores.append(40 if any(s <= faces for s in LARGE_STRAIGHTS) else 0)
+    scores.append(50 if most == 5 else 0)
+    scores.append(total)
+    return tuple(scores)
+
+
+# Every sorted hand, the canonical index of each, and the score table.
+HANDS = tuple(combinations_with_replacement(range(1, 7), 5))
+HAND_INDEX = dict((hand, i) for i, hand in enumerate(HANDS))
+SCORES = tuple(_score_hand(hand) for hand in HANDS)
+
+
+def category_index(category):
+    """Returns the column in SCORES for a CategoryType."""
+    return category.number - 1
+
+
+def hand_index(dice):
+    """Returns the canonical index of five dice in HANDS.
+    Raises:
+        ValueError: if the dice are not five values between 1 and 6."""
+    try:
+        return HAND_INDEX[tuple(sorted(dice))]
+    except KeyError:
+        raise ValueError('Invalid dice: {}'.format(dice))
+
+
+def score(dice, category):
+    """Returns the score of the dice in the given CategoryType."""
+    return SCORES[hand_index(dice)][category.number - 1]
+
+
+def score_all(dice):
+    """Returns a tuple with the score of the dice in all 13 categories,
+    ordered by CategoryType number."""
+    return SCORES[hand_index(dice)]
+
+
+def is_yahtzee(dice):
+    """Returns whether or not all five dice are the same."""
+    return SCORES[hand_index(dice)][YAHTZEE] == 50
+
+
+def earns_yahtzee_bonus(category_scores, dice):
+    """Returns whether scoring dice, in any category, earns a YAHTZEE
+    bonus: the dice are a YAHTZEE and the YAHTZEE box of category_scores (a
+    CategoryScores) already holds 50.  A 0 in the box earns no bonus, and
+    there are no Joker rules."""
+    return category_scores.get(YAHTZEE) == 50 and is_yahtzee(dice)
+
+
+def score_batch(dice):
+    """Scores many hands at once with array operations.
+    Args:
+        dice: An (N, 5) integer array (or nested list) of dice values.
+    Returns:
+        An (N, 13) integer array with the score of each hand in every
+        category, ordered by CategoryType number.
+    Raises:
+        ValueError: if the array is not (N, 5) of integers or holds values
+            outside 1-6."""
+    if numpy is None:
+        raise ImportError('score_batch requires numpy')
+
+    dice = numpy.asarray(dice)
+    if dice.ndim != 2 or dice.shape[1] != 5:
+        raise ValueError('Expected an (N, 5) array of dice, got {}'.format(
+            dice.shape))
+    if dice.size and dice.dtype.kind not in 'iu':
+        raise ValueError('Expected integer dice, got {}'.format(dice.dtype))
+    if dice.size and (dice.min() < 1 or dice.max() > 6):
+        raise ValueError('Dice values must be between 1 and 6')
+
+    faces = numpy.arange(1, 7)
+    # counts[n, v - 1] is the number of dice showing v in hand n.
+    counts = (dice[:, :, numpy.newaxis] == faces).sum(axis=1)
+    present = counts > 0
+    most = counts.max(axis=1)
+    total = dice.sum(axis=1)
+
+    small = (present[:, 0:3] & present[:, 1:4] &
+             present[:, 2:5] & present[:, 3:6]).any(axis=1)
+    large = (present[:, 0:2] & present[:, 1:3] & present[:, 2:4] &
+             present[:, 3:5] & present[:, 4:6]).any(axis=1)
+    full = (counts == 3).any(axis=1) & (counts == 2).any(axis=1)
+
+    return numpy.column_stack((
+        counts * faces,
+        numpy.where(most >= 3, total, 0),
+        numpy.where(most >= 4, total, 0),
+        numpy.where(full, 25, 0),
+        numpy.where(small, 30, 0),
+        numpy.where(large, 40, 0),
+        numpy.where(most == 5, 50, 0),
+        total)).astype(numpy.int32)
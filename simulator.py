@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+import argparse
+import math
+import multiprocessing
+import random
+import time
+from collections import Counter
+
+import dice
+import scoring
+import solver
+from scoresheet import CategoryScores
+
+"""
+simulator.py - Plays complete games without the datastore.
+
+SimulatedGame follows the same rules as Game.roll_dice, Game.roll_again and
+Game.score_roll but keeps everything in memory, so strategies can be
+compared over millions of games spread across a process pool.
+
+A strategy is a callable that takes a SimulatedGame after each roll and
+returns either a list of five keepers (1 to keep a die, 0 to reroll it) to
+roll again, or the index of a category (see scoring.py) to score the dice in.
+After the third roll it must return a category.  Strategies are passed to
+worker processes by reference, so they must be module-level functions.
+
+    python simulator.py --games 1000000 greedy optimal
+"""
+
+NUM_TURNS = scoring.NUM_CATEGORIES
+
+# Number of games each worker plays before reporting back.
+CHUNK_SIZE = 1000
+
+
+class SimulatedGame(object):
+    """In-memory game with the same rules as Game."""
+
+    def __init__(self, stream=None):
+        self.stream = stream or dice.DiceStream(dice.new_seed())
+        self.turn_count = 0
+        self.roll_count = 0
+        self.dice = []
+        self.yahtzee_bonus_count = 0
+        self.category_scores = CategoryScores()
+
+    def roll_dice(self):
+        """Rolls all five dice for a new turn."""
+        self.turn_count += 1
+        self.roll_count = 1
+        self.dice = self.stream.draw(5)
+
+    def roll_again(self, keepers):
+        """Rerolls every die whose keeper is 0."""
+        if self.roll_count == 3:
+            raise ValueError('Already rolled dice 3 times in this turn.')
+        self.roll_count += 1
+        rerolled = iter(self.stream.draw(keepers.count(0)))
+        for i in range(5):
+            if keepers[i] == 0:
+                self.dice[i] = next(rerolled)
+
+    def score_roll(self, category):
+        """Scores the current dice in the category at index category."""
+        if self.category_scores.is_filled(category):
+            raise ValueError('{} category already contains a score.'.format(
+                scoring.CATEGORY_NAMES[category]))
+
+        if scoring.earns_yahtzee_bonus(self.category_scores, self.dice):
+            self.yahtzee_bonus_count += 1
+        self.category_scores.set(
+            category, scoring.SCORES[scoring.hand_index(self.dice)][category])
+
+        self.roll_count = 0
+        self.dice = []
+
+    def open_categories(self):
+        """Returns the index of every category not yet scored."""
+        return self.category_scores.open_categories()
+
+    def final_score(self):
+        """Returns the total score, bonuses included."""
+        total = self.category_scores.total()
+        if (self.category_scores.upper_section_total() >=
+                scoring.UPPER_BONUS_THRESHOLD):
+            total += scoring.UPPER_BONUS
+        return total + scoring.YAHTZEE_BONUS * self.yahtzee_bonus_count
+
+
+def play_game(strategy, stream=None):
+    """Plays a complete game with strategy, drawing dice from stream, and
+    returns the final score."""
+    game = SimulatedGame(stream)
+    for turn in range(NUM_TURNS):
+        game.roll_dice()
+        move = strategy(game)
+        while isinstance(move, list):
+            game.roll_again(move)
+            move = strategy(game)
+        game.score_roll(move)
+    return game.final_score()
+
+
+# Strategies
+
+def greedy_strategy(game):
+    """Never rerolls and scores the open category worth the most points."""
+    scores = scoring.score_all(game.dice)
+    return max(game.open_categories(), key=lambda c: scores[c])
+
+
+def optimal_strategy(game):
+    """Plays the moves that maximize the expected final score, using the
+    table written by solver.py."""
+    state_values = solver.get_state_values()
+    state = solver.game_state(game.category_scores)
+    if game.roll_count < 3:
+        keepers, expected_value = state_values.rank_keepers(
+            state, game.dice, 3 - game.roll_count)[0]
+        if 0 in keepers:
+            return keepers
+    return state_values.best_category(state, game.dice)[0]
+
+
+STRATEGIES = {
+    'greedy': greedy_strategy,
+    'optimal': optimal_strategy,
+}
+
+
+# Tournaments
+
+class ScoreDistribution(object):
+    """Histogram of final scores with summary statistics."""
+
+    def __init__(self, counts=None):
+        self.counts = Counter(counts or {})
+
+    def add(self, counts):
+        self.counts.update(counts)
+
+    @property
+    def games(self):
+        return sum(self.counts.values())
+
+    @property
+    def mean(self):
+        return float(sum(score * n for score, n in self.counts.items())) / \
+            self.games
+
+    @property
+    def stdev(self):
+        mean = self.mean
+        return math.sqrt(sum(n * (score - mean) ** 2
+                             for score, n in self.counts.items()) /
+                         float(self.games))
+
+    def percentile(self, p):
+        """Returns the lowest score at or above p percent of games."""
+        target = p / 100.0 * self.games
+        seen = 0
+        for score in sorted(self.counts):
+            seen += self.counts[score]
+            if seen >= target:
+                return score
+
+    def summary(self):
+        return {'games': self.games,
+                'mean': self.mean,
+                'stdev': self.stdev,
+                'min': min(self.counts),
+                'p10': self.percentile(10),
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'max': max(self.counts)}
+
+
+def _play_chunk(args):
+    """Worker: plays count games with one strategy and returns the
+    histogram of final scores."""
+    name, strategy, count, seed = args
+    stream = dice.DiceStream(seed)
+    return name, Counter(play_game(strategy, stream) for i in range(count))
+
+
+def run_tournament(strategies, games, processes=None, seed=None):
+    """Plays games complete games with each strategy across a process pool.
+    Args:
+        strategies: A dict of strategy name to strategy callable.
+        games: The number of games to play with each strategy.
+        processes: The size of the pool (defaults to the number of CPUs).
+        seed: Seed for reproducible results.
+    Returns:
+        A dict of strategy name to ScoreDistribution and the overall
+        throughput in games per second."""
+    seeds = random.Random(seed)
+    tasks = []
+    for name, strategy in sorted(strategies.items()):
+        for start in range(0, games, CHUNK_SIZE):
+            tasks.append((name, strategy, min(CHUNK_SIZE, games - start),
+                          seeds.getrandbits(dice.SEED_BITS)))
+
+    results = dict((name, ScoreDistribution()) for name in strategies)
+    started = time.time()
+    pool = multiprocessing.Pool(processes)
+    try:
+        for name, counts in pool.imap_unordered(_play_chunk, tasks):
+            results[name].add(counts)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - started
+
+    return results, games * len(strategies) / max(elapsed, 1e-9)
+
+
+def _positive(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError('must be at least 1')
+    return number
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Plays complete games with each strategy.')
+    parser.add_argument('strategies', nargs='+', choices=sorted(STRATEGIES))
+    parser.add_argument('--games', type=_positive, default=100000)
+    parser.add_argument('--processes', type=_positive)
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    results, games_per_second = run_tournament(
+        dict((name, STRATEGIES[name]) for name in args.strategies),
+        args.games, args.processes, args.seed)
+
+    for name in args.strategies:
+        print('{name}: games={games} mean={mean:.2f} stdev={stdev:.2f} '
+              'min={min} p10={p10} p50={p50} p90={p90} max={max}'.format(
+                  name=name, **results[name].summary()))
+    print('{:.0f} games/sec'.format(games_per_second))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+
+import logging
+import os
+import struct
+import sys
+import threading
+from collections import OrderedDict
+
+try:
+    import mmap
+except ImportError:
+    mmap = None
+
+import rerolls
+import scoring
+from scoring import UPPER_BONUS_THRESHOLD, UPPER_BONUS, YAHTZEE_BONUS
+
+"""
+solver.py - Optimal strategy for solitaire Yahtzee.
+
+The state of a game between turns is the set of filled categories, the
+upper section total (capped at 63, since only reaching the 35-point bonus
+matters) and whether the YAHTZEE box holds 50.  build_table works backwards
+from a full scorecard and writes the expected number of points still to come
+from every state to a flat file of little-endian floats.  StateValues reads
+that file through mmap, so every process serving the API shares one copy of
+the table from the page cache and nothing is unpickled.
+
+Build the table once before deploying:
+
+    python solver.py [path]
+"""
+
+ALL_FILLED = (1 << scoring.NUM_CATEGORIES) - 1
+UPPER_TOTALS = UPPER_BONUS_THRESHOLD + 1
+NUM_STATES = (ALL_FILLED + 1) * UPPER_TOTALS * 2
+
+TABLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'state_values.bin')
+
+# File header: magic, format version, number of states.
+_HEADER = struct.Struct('<4sII')
+_MAGIC = b'YZEV'
+_VERSION = 1
+_VALUE = struct.Struct('<f')
+
+# Number of (state, rerolls left) hand value lists kept by StateValues.
+HAND_VALUES_CACHE_SIZE = 256
+
+
+def state_index(state):
+    """Returns the position of a (filled, upper_total, yahtzee_scored)
+    state in the table."""
+    filled, upper_total, yahtzee_scored = state
+    return ((filled * UPPER_TOTALS + min(upper_total, UPPER_BONUS_THRESHOLD))
+            << 1) | bool(yahtzee_scored)
+
+
+def game_state(category_scores):
+    """Returns the (filled, upper_total, yahtzee_scored) state of a
+    scoresheet.CategoryScores."""
+    return (category_scores.filled,
+            min(category_scores.upper_section_total(),
+                UPPER_BONUS_THRESHOLD),
+            category_scores.get(scoring.YAHTZEE) == 50)
+
+
+def score_outcome(state, hand, category):
+    """Returns the points earned, bonuses included, and the next state for
+    scoring scoring.HANDS[hand] in the category at index category."""
+    filled, upper_total, yahtzee_scored = state
+    score = scoring.SCORES[hand][category]
+    points = score
+
+    if yahtzee_scored and scoring.SCORES[hand][scoring.YAHTZEE] == 50:
+        points += YAHTZEE_BONUS
+
+    if category in scoring.UPPER_SECTION:
+        new_total = min(upper_total + score, UPPER_BONUS_THRESHOLD)
+        if upper_total < UPPER_BONUS_THRESHOLD <= new_total:
+            points += UPPER_BONUS
+        upper_total = new_total
+    elif category == scoring.YAHTZEE and score == 50:
+        yahtzee_scored = True
+
+    return points, (filled | (1 << category), upper_total, yahtzee_scored)
+
+
+def open_categories(state):
+    """Returns the index of every category not yet filled."""
+    filled = state[0]
+    return [c for c in range(scoring.NUM_CATEGORIES)
+            if not filled & (1 << c)]
+
+
+class StateValues(object):
+    """Read-only view of a state-value table written by build_table."""
+
+    def __init__(self, path=TABLE_PATH):
+        with open(path, 'rb') as f:
+            if mmap is not None:
+                self._buffer = mmap.mmap(f.fileno(), 0,
+                                         access=mmap.ACCESS_READ)
+            else:
+                self._buffer = f.read()
+
+        if len(self._buffer) != _HEADER.size + NUM_STATES * _VALUE.size:
+            raise ValueError('State value table {} is truncated'.format(path))
+        magic, version, count = _HEADER.unpack_from(self._buffer, 0)
+        if magic != _MAGIC or version != _VERSION or count != NUM_STATES:
+            raise ValueError(
+                'State value table {} has an unexpected format'.format(path))
+
+        self._hand_values = OrderedDict()
+        # Requests share one StateValues, so the cache is changed under a
+        # lock.
+        self._lock = threading.Lock()
+
+    def value(self, state):
+        """Returns the expected points still to come from a state."""
+        offset = _HEADER.size + state_index(state) * _VALUE.size
+        return _VALUE.unpack_from(self._buffer, offset)[0]
+
+    def rank_categories(self, state, dice):
+        """Returns (category, points, expected_value) for every open
+        category, best first.  expected_value is the points earned now plus
+        the expected points from the rest of the game."""
+        hand = scoring.hand_index(dice)
+        ranking = []
+        for category in open_categories(state):
+            points, next_state = score_outcome(state, hand, category)
+            ranking.append((category, points,
+                            points + self.value(next_state)))
+        ranking.sort(key=lambda option: option[2], reverse=True)
+        return ranking
+
+    def best_category(self, state, dice):
+        """Returns (category, points, expected_value) for the open category
+        with the highest expected value."""
+        return self.rank_categories(state, dice)[0]
+
+    def hand_values(self, state, rerolls_left):
+        """Returns the expected value of holding each hand in scoring.HANDS
+        with rerolls_left rerolls still available this turn.  The most
+        recently used lists are cached, since the rolls of a turn and the
+        early turns of most games share their states."""
+        key = (state, rerolls_left)
+        with self._lock:
+            values = self._hand_values.pop(key, None)
+            if values is not None:
+                self._hand_values[key] = values
+                return values
+
+        # Computed without the lock, which the recursive call takes again;
+        # two requests may compute the same list, with the same result.
+        if rerolls_left == 0:
+            categories = open_categories(state)
+            # Only a few next states are reachable, so read each once.
+            future = {}
+            values = []
+            for hand in range(len(scoring.HANDS)):
+                best = None
+                for category in categories:
+                    points, next_state = score_outcome(state, hand,
+                                                       category)
+                    if next_state not in future:
+                        future[next_state] = self.value(next_state)
+                    value = points + future[next_state]
+                    if best is None or value > best:
+                        best = value
+                values.append(best)
+        else:
+            keep_values = rerolls.expected_values(
+                self.hand_values(state, rerolls_left - 1))
+            values = [max(keep_values[k] for k in keeps)
+                      for keeps in rerolls.HAND_KEEPS]
+
+        with self._lock:
+            self._hand_values.pop(key, None)
+            self._hand_values[key] = values
+            if len(self._hand_values) > HAND_VALUES_CACHE_SIZE:
+                self._hand_values.popitem(last=False)
+        return values
+
+    def rank_keepers(self, state, dice, rerolls_left):
+        """Returns (keepers, expected_value) for every distinct set of dice
+        that can be held for the next reroll, best first.  keepers is the
+        list of 0s and 1s that roll_again expects."""
+        after = self.hand_values(state, rerolls_left - 1)
+        ranking = []
+        for k in rerolls.HAND_KEEPS[scoring.hand_index(dice)]:
+            expected = sum(p * after[h] for h, p in rerolls.TRANSITIONS[k])
+            ranking.append((rerolls.keepers_mask(dice, rerolls.KEEPS[k]),
+                            expected))
+        ranking.sort(key=lambda option: option[1], reverse=True)
+        return ranking
+
+
+_state_values = None
+_state_values_lock = threading.Lock()
+
+
+def get_state_values():
+    """Returns the StateValues for TABLE_PATH, opening it on first use."""
+    global _state_values
+    with _state_values_lock:
+        if _state_values is None:
+            _state_values = StateValues()
+    return _state_values
+
+
+def build_table(path=TABLE_PATH):
+    """Solves every state with numpy and writes the table to path."""
+    import numpy
+
+    num_hands = len(scoring.HANDS)
+    scores = numpy.array(scoring.SCORES)
+    yahtzees = (scores[:, scoring.YAHTZEE] == 50).astype(int)
+
+    transitions = numpy.zeros((len(rerolls.KEEPS), num_hands))
+    for k, pairs in enumerate(rerolls.TRANSITIONS):
+        for hand, probability in pairs:
+            transitions[k, hand] = probability
+    transitions = transitions.T.copy()
+    first_roll = transitions[:, rerolls.ROLL_ALL].copy()
+
+    # Pad every hand's keeps to the same width by repeating one of them.
+    width = max(len(keeps) for keeps in rerolls.HAND_KEEPS)
+    hand_keeps = numpy.array([keeps + keeps[:1] * (width - len(keeps))
+                              for keeps in rerolls.HAND_KEEPS])
+
+    uppers = numpy.arange(UPPER_TOTALS)[:, numpy.newaxis]
+    values = numpy.zeros((ALL_FILLED + 1, UPPER_TOTALS, 2))
+
+    for filled in range(ALL_FILLED - 1, -1, -1):
+        # best[u, y, h] is the value of ending a turn holding hand h.
+        best = numpy.empty((UPPER_TOTALS, 2, num_hands))
+        best.fill(-numpy.inf)
+        for category in range(scoring.NUM_CATEGORIES):
+            if filled & (1 << category):
+                continue
+            after = values[filled | (1 << category)]
+            points = scores[:, category]
+
+            if category in scoring.UPPER_SECTION:
+                new_totals = numpy.minimum(uppers + points,
+                                           UPPER_BONUS_THRESHOLD)
+                earned = points + UPPER_BONUS * (
+                    (uppers < UPPER_BONUS_THRESHOLD) &
+                    (new_totals >= UPPER_BONUS_THRESHOLD))
+                total = (earned[:, numpy.newaxis, :] +
+                         after[new_totals].transpose(0, 2, 1))
+            elif category == scoring.YAHTZEE:
+                total = numpy.empty_like(best)
+                for scored in (0, 1):
+                    total[:, scored, :] = points + after[:, scored | yahtzees]
+            else:
+                total = points + after[:, :, numpy.newaxis]
+
+            numpy.maximum(best, total, out=best)
+
+        best[:, 1, :] += YAHTZEE_BONUS * yahtzees
+
+        hand_values = best.reshape(-1, num_hands)
+        for reroll in range(2):
+            keep_values = numpy.dot(hand_values, transitions)
+            hand_values = keep_values[:, hand_keeps].max(axis=2)
+        values[filled] = numpy.dot(hand_values, first_roll).reshape(
+            UPPER_TOTALS, 2)
+
+        if filled % 512 == 0:
+            logging.info('Solved %d of %d scorecards',
+                         ALL_FILLED - filled, ALL_FILLED)
+
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(_HEADER.pack(_MAGIC, _VERSION, NUM_STATES))
+        values.astype('<f4').tofile(f)
+    os.rename(temp_path, path)
+
+    logging.info('Expected score of a new game: %.2f', values[0, 0, 0])
+    return path
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    build_table(*sys.argv[1:])
@@ -0,0 +1,495 @@
+import base64
+import cPickle as pickle
+import itertools
+import operator
+import os
+import threading
+
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+"""
+storage.py - Repository layer between the game logic and the datastore.
+
+Models and endpoints read and write entities through the active repository
+instead of calling key.get(), put() and Model.query() directly, so the same
+game logic can run against:
+
+    NdbRepository      the App Engine datastore (the default)
+    MemoryRepository   a dict in this process
+    SqliteRepository   a SQLite file, for local load tests and bot workloads
+
+The backend is chosen with the YAHTZEE_STORAGE environment variable ('ndb',
+'memory' or 'sqlite:<path>') or with set_repository.  The memory and SQLite
+backends still use the ndb model classes and keys, but make no datastore
+RPCs; entities are stored as their pickled protocol buffers so that, as with
+the datastore, changes are only visible to other readers after a put.
+
+Queries take a list of (property name, operator, value) filters and an
+optional property name to order by, prefixed with '-' for descending order.
+Long result sets are read a page at a time with query_page, which returns
+an opaque cursor string for the next page, or streamed with iterate, which
+fetches them in batches.  Both take an optional projection, a list of
+property names, to read only those properties from the datastore index
+(the local backends return whole entities).
+
+Functions registered with add_write_listener are called after every put
+and delete made through the module shortcuts, or after the transaction
+they were made in commits, so caches can follow the stored entities.
+Functions registered with add_operation_listener are called before every
+read and write, so request metrics can count them.
+"""
+
+# Number of entities fetched per RPC by iterate.
+BATCH_SIZE = 100
+
+_OPERATORS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+
+class Repository(object):
+    """Interface implemented by every storage backend."""
+
+    def get(self, key):
+        """Returns the entity for key, or None if it does not exist."""
+        return self.get_multi([key])[0]
+
+    def get_multi(self, keys):
+        """Returns the entity (or None) for each key, in order."""
+        raise NotImplementedError
+
+    def put(self, entity):
+        """Stores entity, assigning it a key if it has none."""
+        return self.put_multi([entity])[0]
+
+    def put_multi(self, entities):
+        """Stores every entity in one batch and returns their keys."""
+        raise NotImplementedError
+
+    def allocate_key(self, model):
+        """Returns a new key of model that no stored entity will be given,
+        so that an entity and others that refer to it can be stored in one
+        batch."""
+        raise NotImplementedError
+
+    def delete(self, key):
+        self.delete_multi([key])
+
+    def delete_multi(self, keys):
+        raise NotImplementedError
+
+    def query(self, model, filters=(), order=None, limit=None, offset=0):
+        """Returns a list of the entities of model matching filters."""
+        raise NotImplementedError
+
+    def query_page(self, model, filters=(), order=None, page_size=20,
+                   cursor=None, projection=None):
+        """Returns a page of the entities of model matching filters, the
+        cursor of the next page and whether there are more results.
+        cursor is None for the first page, or a cursor returned by a
+        previous call with the same query.  Raises ValueError for an
+        invalid cursor."""
+        raise NotImplementedError
+
+    def iterate(self, model, filters=(), order=None, batch_size=BATCH_SIZE,
+                projection=None):
+        """Yields every entity of model matching filters, fetching
+        batch_size entities at a time."""
+        cursor = None
+        more = True
+        while more:
+            results, cursor, more = self.query_page(
+                model, filters, order, batch_size, cursor, projection)
+            for entity in results:
+                yield entity
+
+    def first(self, model, filters=(), order=None):
+        """Returns the first entity matching filters, or None."""
+        results = self.query(model, filters, order, limit=1)
+        return results[0] if results else None
+
+    def run_in_transaction(self, function, *args, **kwargs):
+        """Calls function(*args, **kwargs) in a transaction that may span
+        entity groups, and returns its result."""
+        raise NotImplementedError
+
+
+class NdbRepository(Repository):
+    """Stores entities in the App Engine datastore."""
+
+    def get_multi(self, keys):
+        return ndb.get_multi(keys)
+
+    def put_multi(self, entities):
+        return ndb.put_multi(entities)
+
+    def allocate_key(self, model):
+        first, last = model.allocate_ids(1)
+        return ndb.Key(model, first)
+
+    def delete_multi(self, keys):
+        ndb.delete_multi(keys)
+
+    def _query(self, model, filters, order):
+        query = model.query()
+        for name, op, value in filters:
+            query = query.filter(_OPERATORS[op](getattr(model, name), value))
+        if order:
+            prop = getattr(model, order.lstrip('-'))
+            query = query.order(-prop if order.startswith('-') else prop)
+        return query
+
+    def query(self, model, filters=(), order=None, limit=None, offset=0):
+        return self._query(model, filters, order).fetch(limit, offset=offset)
+
+    def query_page(self, model, filters=(), order=None, page_size=20,
+                   cursor=None, projection=None):
+        query = self._query(model, filters, order)
+        try:
+            results, next_cursor, more = query.fetch_page(
+                page_size,
+                start_cursor=Cursor(urlsafe=cursor) if cursor else None,
+                projection=projection)
+        except (datastore_errors.BadValueError,
+                datastore_errors.BadRequestError):
+            raise ValueError('Invalid cursor {!r}'.format(cursor))
+        return (results, next_cursor.urlsafe() if next_cursor else None,
+                more)
+
+    def iterate(self, model, filters=(), order=None, batch_size=BATCH_SIZE,
+                projection=None):
+        return self._query(model, filters, order).iter(
+            batch_size=batch_size, projection=projection)
+
+    def run_in_transaction(self, function, *args, **kwargs):
+        return ndb.transaction(lambda: function(*args, **kwargs), xg=True)
+
+
+class _LocalRepository(Repository):
+    """Common code for backends that keep pickled entities locally and
+    evaluate queries in Python."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+
+    def _allocate_id(self, kind):
+        """Returns the next integer id of a kind."""
+        raise NotImplementedError
+
+    def _load(self, keys):
+        """Returns the stored pickle for each key, or None."""
+        raise NotImplementedError
+
+    def _store(self, items):
+        """Stores (key, kind, pickle) triples."""
+        raise NotImplementedError
+
+    def _remove(self, keys):
+        raise NotImplementedError
+
+    def _kind(self, kind):
+        """Returns the stored pickle of every entity of a kind."""
+        raise NotImplementedError
+
+    def get_multi(self, keys):
+        with self._lock:
+            data = self._load(keys)
+        return [pickle.loads(d) if d is not None else None for d in data]
+
+    def put_multi(self, entities):
+        with self._lock:
+            for entity in entities:
+                if entity.key is None:
+                    kind = entity._get_kind()
+                    entity.key = ndb.Key(kind, self._allocate_id(kind))
+            self._store([(entity.key, entity._get_kind(),
+                          pickle.dumps(entity, pickle.HIGHEST_PROTOCOL))
+                         for entity in entities])
+        return [entity.key for entity in entities]
+
+    def allocate_key(self, model):
+        kind = model._get_kind()
+        with self._lock:
+            return ndb.Key(kind, self._allocate_id(kind))
+
+    def delete_multi(self, keys):
+        with self._lock:
+            self._remove(keys)
+
+    def run_in_transaction(self, function, *args, **kwargs):
+        # The lock is reentrant, so reads and writes made by function
+        # happen while every other thread is kept out.  Writes made before
+        # an exception are not rolled back.
+        with self._lock:
+            return function(*args, **kwargs)
+
+    def query(self, model, filters=(), order=None, limit=None, offset=0):
+        with self._lock:
+            data = self._kind(model._get_kind())
+        results = [pickle.loads(d) for d in data]
+        for name, op, value in filters:
+            compare = _OPERATORS[op]
+            results = [entity for entity in results
+                       if compare(getattr(entity, name), value)]
+        if order:
+            results.sort(key=lambda entity: getattr(entity,
+                                                    order.lstrip('-')),
+                         reverse=order.startswith('-'))
+        else:
+            results.sort(key=lambda entity: entity.key.id())
+        end = offset + limit if limit is not None else None
+        return results[offset:end]
+
+    def query_page(self, model, filters=(), order=None, page_size=20,
+                   cursor=None, projection=None):
+        # The cursor is the encoded offset of the next page.
+        offset = 0
+        if cursor:
+            try:
+                offset = int(base64.urlsafe_b64decode(str(cursor)))
+            except (TypeError, ValueError):
+                offset = -1
+            if offset < 0:
+                raise ValueError('Invalid cursor {!r}'.format(cursor))
+        results = self.query(model, filters, order, page_size + 1, offset)
+        more = len(results) > page_size
+        next_cursor = base64.urlsafe_b64encode(str(offset + page_size))
+        return results[:page_size], next_cursor if more else None, more
+
+
+class MemoryRepository(_LocalRepository):
+    """Stores entities in a dict in this process."""
+
+    def __init__(self):
+        super(MemoryRepository, self).__init__()
+        self._entities = {}
+        self._ids = itertools.count(1)
+
+    def _allocate_id(self, kind):
+        return next(self._ids)
+
+    def _load(self, keys):
+        return [self._entities.get(key, (None, None))[1] for key in keys]
+
+    def _store(self, items):
+        for key, kind, data in items:
+            self._entities[key] = (kind, data)
+
+    def _remove(self, keys):
+        for key in keys:
+            self._entities.pop(key, None)
+
+    def _kind(self, kind):
+        return [data for k, data in self._entities.values() if k == kind]
+
+
+class SqliteRepository(_LocalRepository):
+    """Stores entities in a SQLite file, one row per entity."""
+
+    def __init__(self, path):
+        super(SqliteRepository, self).__init__()
+        import sqlite3
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS entities ('
+                             'key TEXT PRIMARY KEY, kind TEXT, data BLOB)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS entities_kind '
+                             'ON entities (kind)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS ids ('
+                             'kind TEXT PRIMARY KEY, last_id INTEGER)')
+
+    def _allocate_id(self, kind):
+        with self._db:
+            row = self._db.execute('SELECT last_id FROM ids WHERE kind = ?',
+                                   (kind,)).fetchone()
+            new_id = row[0] + 1 if row else 1
+            self._db.execute('INSERT OR REPLACE INTO ids VALUES (?, ?)',
+                             (kind, new_id))
+        return new_id
+
+    def _load(self, keys):
+        found = {}
+        urlsafes = [key.urlsafe() for key in keys]
+        for start in range(0, len(urlsafes), 500):
+            batch = urlsafes[start:start + 500]
+            found.update(self._db.execute(
+                'SELECT key, data FROM entities WHERE key IN ({})'.format(
+                    ', '.join('?' * len(batch))), batch))
+        return [str(found[u]) if u in found else None for u in urlsafes]
+
+    def _store(self, items):
+        import sqlite3
+        with self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO entities VALUES (?, ?, ?)',
+                [(key.urlsafe(), kind, sqlite3.Binary(data))
+                 for key, kind, data in items])
+
+    def _remove(self, keys):
+        with self._db:
+            self._db.executemany('DELETE FROM entities WHERE key = ?',
+                                 [(key.urlsafe(),) for key in keys])
+
+    def _kind(self, kind):
+        return [str(row[0]) for row in self._db.execute(
+            'SELECT data FROM entities WHERE kind = ?', (kind,))]
+
+
+_repository = None
+_write_listeners = []
+_operation_listeners = []
+_pending = threading.local()
+
+
+def _from_environment():
+    setting = os.environ.get('YAHTZEE_STORAGE', 'ndb')
+    if setting == 'memory':
+        return MemoryRepository()
+    if setting.startswith('sqlite:'):
+        return SqliteRepository(setting[len('sqlite:'):])
+    return NdbRepository()
+
+
+def get_repository():
+    """Returns the active repository."""
+    global _repository
+    if _repository is None:
+        _repository = _from_environment()
+    return _repository
+
+
+def set_repository(repository):
+    """Replaces the active repository, e.g. with a MemoryRepository for a
+    load test."""
+    global _repository
+    _repository = repository
+
+
+def add_write_listener(listener):
+    """Registers listener(entities, deleted_keys) to be called with the
+    entities stored and the keys deleted by each write."""
+    _write_listeners.append(listener)
+
+
+def _written(entities, deleted_keys):
+    writes = getattr(_pending, 'writes', None)
+    if writes is not None:
+        writes.append((entities, deleted_keys))
+        return
+    for listener in _write_listeners:
+        listener(entities, deleted_keys)
+
+
+def add_operation_listener(listener):
+    """Registers listener(operation, count) to be called before each read
+    or write, where operation is 'get', 'put' or 'delete' with the number
+    of entities, or 'query' with 1."""
+    _operation_listeners.append(listener)
+
+
+def remove_operation_listener(listener):
+    """Unregisters a listener added with add_operation_listener."""
+    _operation_listeners.remove(listener)
+
+
+def _operated(operation, count):
+    for listener in _operation_listeners:
+        listener(operation, count)
+
+
+# Shortcuts for the active repository.
+
+def get(key):
+    _operated('get', 1)
+    return get_repository().get(key)
+
+
+def get_multi(keys):
+    _operated('get', len(keys))
+    return get_repository().get_multi(keys)
+
+
+def put(entity):
+    _operated('put', 1)
+    key = get_repository().put(entity)
+    _written([entity], [])
+    return key
+
+
+def put_multi(entities):
+    _operated('put', len(entities))
+    keys = get_repository().put_multi(entities)
+    _written(entities, [])
+    return keys
+
+
+def allocate_key(model):
+    return get_repository().allocate_key(model)
+
+
+def delete(key):
+    _operated('delete', 1)
+    get_repository().delete(key)
+    _written([], [key])
+
+
+def delete_multi(keys):
+    _operated('delete', len(keys))
+    get_repository().delete_multi(keys)
+    _written([], keys)
+
+
+def query(model, filters=(), order=None, limit=None, offset=0):
+    _operated('query', 1)
+    return get_repository().query(model, filters, order, limit, offset)
+
+
+def query_page(model, filters=(), order=None, page_size=20, cursor=None,
+               projection=None):
+    _operated('query', 1)
+    return get_repository().query_page(model, filters, order, page_size,
+                                       cursor, projection)
+
+
+def iterate(model, filters=(), order=None, batch_size=BATCH_SIZE,
+            projection=None):
+    _operated('query', 1)
+    return get_repository().iterate(model, filters, order, batch_size,
+                                    projection)
+
+
+def first(model, filters=(), order=None):
+    _operated('query', 1)
+    return get_repository().first(model, filters, order)
+
+
+def commit(entities):
+    """Stores entities with one put_multi in a transaction."""
+    return run_in_transaction(put_multi, entities)
+
+
+def run_in_transaction(function, *args, **kwargs):
+    if getattr(_pending, 'writes', None) is not None:
+        # Already in a transaction.
+        return function(*args, **kwargs)
+
+    def attempt():
+        # Writes from an attempt that was retried were never committed.
+        _pending.writes = []
+        return function(*args, **kwargs)
+
+    try:
+        result = get_repository().run_in_transaction(attempt)
+        writes = _pending.writes
+    finally:
+        _pending.writes = None
+    for entities, deleted_keys in writes:
+        _written(entities, deleted_keys)
+    return result
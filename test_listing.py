@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+import collections
+import datetime
+import unittest
+
+import appengine_stubs
+
+appengine_stubs.install()
+
+import storage
+from game import Game, Score
+from user import User
+
+"""test_listing.py - Checks that listing N games or scores makes the same
+number of datastore calls for any N.
+
+Runs on a storage.MemoryRepository, with the stand-ins from
+appengine_stubs.py when the App Engine SDK is not installed:
+
+    python -m unittest test_listing
+"""
+
+SIZES = (1, 5, 20)
+
+
+class ListingCallsTest(unittest.TestCase):
+
+    def setUp(self):
+        storage.set_repository(storage.MemoryRepository())
+        self.calls = collections.Counter()
+        self._counting = False
+        storage.add_operation_listener(self._count)
+
+    def tearDown(self):
+        storage.remove_operation_listener(self._count)
+
+    def _count(self, operation, count):
+        # Calls, not entities: a get_multi of N keys is one call.
+        if self._counting:
+            self.calls[operation] += 1
+
+    def _users(self, count):
+        users = [User(name='user{}'.format(i), email=None)
+                 for i in range(count)]
+        storage.put_multi(users)
+        return users
+
+    def _calls(self, list_page):
+        """Returns the calls per operation made by list_page()."""
+        self.calls.clear()
+        self._counting = True
+        try:
+            list_page()
+        finally:
+            self._counting = False
+        return dict(self.calls)
+
+    def test_game_listing(self):
+        calls = {}
+        for size in SIZES:
+            storage.set_repository(storage.MemoryRepository())
+            # Half of the games share a user, so duplicate keys are covered.
+            users = self._users(size)
+            for i in range(size):
+                Game.new_game(users[i // 2].key).roll_dice()
+
+            def list_page():
+                games, cursor, more = storage.query_page(
+                    Game, page_size=size)
+                self.assertEqual(len(Game.to_forms(games)), size)
+            calls[size] = self._calls(list_page)
+
+        for size in SIZES:
+            self.assertEqual(calls[size], calls[SIZES[0]],
+                             'Listing {} games made {}, listing {} made {}'
+                             .format(size, calls[size], SIZES[0],
+                                     calls[SIZES[0]]))
+        self.assertEqual(calls[SIZES[0]].get('get'), 1)
+
+    def test_score_listing(self):
+        calls = {}
+        for size in SIZES:
+            storage.set_repository(storage.MemoryRepository())
+            users = self._users(size)
+            today = datetime.date.today()
+            storage.put_multi([Score(user=user.key, date=today, score=i)
+                               for i, user in enumerate(users)])
+
+            def list_page():
+                scores = storage.query(Score, order='-score', limit=size)
+                self.assertEqual(len(Score.to_forms(scores)), size)
+            calls[size] = self._calls(list_page)
+
+        for size in SIZES:
+            self.assertEqual(calls[size], calls[SIZES[0]])
+        self.assertEqual(calls[SIZES[0]].get('get'), 1)
+
+    def test_deleted_user(self):
+        users = self._users(2)
+        games = [Game.new_game(user.key) for user in users]
+        storage.put_multi([Score(user=user.key, date=datetime.date.today(),
+                                 score=1) for user in users])
+        storage.delete(users[0].key)
+
+        forms = Game.to_forms(games)
+        self.assertEqual([form.user_name for form in forms],
+                         ['', 'user1'])
+        self.assertEqual(games[0].to_form().user_name, '')
+        scores = storage.query(Score)
+        self.assertEqual(sorted(form.user_name
+                                for form in Score.to_forms(scores)),
+                         ['', 'user1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,32 +1,31 @@
-import random
 from protorpc import messages
 from google.appengine.ext import ndb
 
+import game_history
+import storage
+from properties import DiceProperty
+
 
 class Turn(ndb.Model):
     """Turn object"""
     game = ndb.KeyProperty(required=True, kind='Game')
     number = ndb.IntegerProperty(required=True, default=0)
-    dice = ndb.PickleProperty(required=True)
+    dice = DiceProperty(required=True)
     roll_count = ndb.IntegerProperty(required=True, default=0)
     is_complete = ndb.BooleanProperty(required=True, default=False)
 
     @classmethod
     def new_turn(cls, game, number):
-        """Creates a new turn for a game and rolls the dice."""
+        """Creates a new turn for a game and rolls the dice from the game's
+        stream."""
         turn = Turn(game=game, number=number)
+        game = storage.get(game)
 
-        # Create an array for the dice
-        turn.dice = []
-
-        # Choose a random number between 1 and 6 for each die
-        for i in range(5):
-            value = random.choice(range(1, 7))
-            turn.dice.append(value)
-            print value
+        # Draw a value between 1 and 6 for each die
+        turn.dice = game.draw_dice(5)
 
         turn.roll_count = 1
-        turn.put()
+        storage.commit([turn, game])
         return turn
 
     def to_form(self):
@@ -40,23 +39,19 @@ class Turn(ndb.Model):
 
         self.roll_count += 1
 
-        """Choose a random number between 1 and 6 for
+        """Draw a new value from the game's stream for
         each die that is not marked as a 'keeper'"""
-
+        game = storage.get(self.game)
+        rerolled = iter(game.draw_dice(keepers[:5].count(0)))
         for i in range(5):
             if keepers[i] == 0:
-                value = random.choice(range(1, 7))
-                self.dice[i] = value
-                print value
-
-        self.put()
+                self.dice[i] = next(rerolled)
 
         # Update the game history.
-        game = self.game.get()
-        entry = (self.roll_count, self.dice)
-        game.history[self.number].append(entry)
-        # # Save the game history.
-        game.put()
+        game.update_history(game_history.encode_roll(
+            self.number, self.roll_count, self.dice))
+        # Save the turn and the game history.
+        storage.commit([self, game])
 
         return self.to_form()
 
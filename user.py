@@ -1,10 +1,70 @@
+import threading
+from collections import OrderedDict
+
 from protorpc import messages
 from google.appengine.ext import ndb
 
+import leaderboard
+import storage
+# Registers the entity cache's write listener wherever Users are written,
+# including deferred tasks.
+import utils
+
 """
 user.py - This file contains the class definitions for the User entity.
+
+User names are unique.  Each User has a UserName entity keyed by its name,
+so resolving a name is a strongly consistent get by key instead of a query,
+and creating a User claims its name in the same transaction.  A User
+created before names were indexed is found with a query the first time its
+name is looked up, and its UserName is created then.  Resolved names are
+also kept in a map of name to User key in each instance.
 """
 
+NAME_CACHE_SIZE = 10000
+
+_user_keys = OrderedDict()
+_user_keys_lock = threading.Lock()
+
+
+def _cached_user_key(name):
+    with _user_keys_lock:
+        key = _user_keys.pop(name, None)
+        if key is not None:
+            _user_keys[name] = key
+        return key
+
+
+def _cache_user_key(name, key):
+    with _user_keys_lock:
+        _user_keys.pop(name, None)
+        _user_keys[name] = key
+        while len(_user_keys) > NAME_CACHE_SIZE:
+            _user_keys.popitem(last=False)
+
+
+def _forget_user_key(name):
+    with _user_keys_lock:
+        _user_keys.pop(name, None)
+
+
+def user_names(user_keys):
+    """Returns a dict of User key to name for user_keys, read with a single
+    get_multi, so a list of forms costs one datastore round trip for all of
+    its users."""
+    keys = list(set(user_keys))
+    return dict((key, user.name)
+                for key, user in zip(keys, storage.get_multi(keys)) if user)
+
+
+class UserName(ndb.Model):
+    """Index entity keyed by a User's name"""
+    user = ndb.KeyProperty(kind='User', required=True)
+
+    @classmethod
+    def key_for(cls, name):
+        return ndb.Key(cls, name)
+
 
 class User(ndb.Model):
     """ User object """
@@ -13,6 +73,122 @@ class User(ndb.Model):
     high_score = ndb.IntegerProperty(default=0)
     total_played = ndb.IntegerProperty(default=0)
 
+    @classmethod
+    def create(cls, name, email=None):
+        """Creates a User and claims its name in one transaction.
+        Returns None if the name is already taken."""
+        name_key = UserName.key_for(name)
+        # A User created before names were indexed may hold the name
+        # without a UserName; this indexes it.
+        if cls.get_by_name(name):
+            return None
+        # Allocated first, so the User and its UserName are stored in one
+        # batch.
+        user = cls(key=storage.allocate_key(cls), name=name, email=email)
+
+        def create_user():
+            if storage.get(name_key):
+                return None
+            storage.put_multi([user, UserName(key=name_key, user=user.key)])
+            return user
+
+        user = storage.run_in_transaction(create_user)
+        if user:
+            _cache_user_key(name, user.key)
+        return user
+
+    @classmethod
+    def get_by_name(cls, name):
+        """Returns the User with name, or None."""
+        if not name:
+            return None
+        key = _cached_user_key(name)
+        if key is not None:
+            user = storage.get(key)
+            # The name may have been deleted, and taken again, through
+            # another instance.
+            if user and user.name == name:
+                return user
+            _forget_user_key(name)
+
+        index = storage.get(UserName.key_for(name))
+        if index:
+            user = storage.get(index.user)
+        else:
+            user = cls._index_name(name)
+        if user:
+            _cache_user_key(name, user.key)
+        return user
+
+    @classmethod
+    def _index_name(cls, name):
+        """Returns the User with name found with a query, for Users created
+        before names were indexed, and creates its missing UserName, so
+        the name resolves before /tasks/index_user_names has run.  As
+        there, the first User with a name keeps it."""
+        user = storage.first(cls, [('name', '==', name)])
+        if not user:
+            return None
+        name_key = UserName.key_for(name)
+
+        def index_name():
+            index = storage.get(name_key)
+            if index:
+                # Claimed since the get in get_by_name.
+                return index.user
+            storage.put(UserName(key=name_key, user=user.key))
+            return user.key
+
+        key = storage.run_in_transaction(index_name)
+        return user if key == user.key else storage.get(key)
+
+    def remove(self):
+        """Deletes the User, frees its name and takes it off the
+        leaderboard in one transaction."""
+        name_key = UserName.key_for(self.name)
+
+        def remove_user():
+            # Read again, since its score may have changed since self was.
+            user, index = storage.get_multi([self.key, name_key])
+            if not user:
+                return
+            deleted = [user.key]
+            if index and index.user == user.key:
+                deleted.append(name_key)
+            storage.delete_multi(deleted)
+            if user.is_ranked():
+                storage.put(leaderboard.updated_shard(
+                    user.key, user.high_score, None))
+
+        storage.run_in_transaction(remove_user)
+        _forget_user_key(self.name)
+
+    def update(self, email=None, high_score=None):
+        """Changes the email and high score given and stores the User and
+        its leaderboard shard in one transaction.  Returns the User as
+        stored, or None if it has been deleted.
+        Raises ValueError if high_score is not a possible score."""
+        if high_score is not None:
+            leaderboard.check_score(high_score)
+
+        def update_user():
+            # Read again, so that a score recorded since self was read is
+            # neither lost nor taken off the wrong leaderboard count.
+            user = storage.get(self.key)
+            if not user:
+                return None
+            was_ranked = user.is_ranked()
+            old_high_score = user.high_score
+            if email:
+                user.email = email
+            if high_score:
+                user.high_score = high_score
+            storage.put_multi(
+                [user] + user._ranking_changes(was_ranked, old_high_score))
+            return user
+
+        return storage.run_in_transaction(update_user)
+
     def to_form(self):
         """Returns a UserForm representation of the User
         """
@@ -23,12 +199,33 @@ class User(ndb.Model):
                         high_score=self.high_score)
         return form
 
+    def is_ranked(self):
+        """Returns whether the user is on the leaderboard."""
+        return self.total_played > 0 or self.high_score > 0
+
     def add_score(self, score):
+        """Records the score of a finished game.  Returns the entities
+        changed, the User and its leaderboard shard if its best score
+        changed, for the caller to store in the transaction the User was
+        read in."""
+        was_ranked = self.is_ranked()
+        old_high_score = self.high_score
+
         self.total_played += 1
         if score > self.high_score:
             self.high_score = score
 
-        self.put()
+        return [self] + self._ranking_changes(was_ranked, old_high_score)
+
+    def _ranking_changes(self, was_ranked, old_high_score):
+        """Returns a list of the leaderboard shard updated for a change of
+        the best score, or an empty list if it did not change."""
+        if not self.is_ranked() or (was_ranked and
+                                    self.high_score == old_high_score):
+            return []
+        return [leaderboard.updated_shard(
+            self.key, old_high_score if was_ranked else None,
+            self.high_score)]
 
 
 # Forms
@@ -43,7 +240,18 @@ class UserForm(messages.Message):
     high_score = messages.IntegerField(5, required=True)
 
 
+class UserRankForm(messages.Message):
+    """UserRankForm for a user's position on the leaderboard
+    """
+    user_name = messages.StringField(1, required=True)
+    high_score = messages.IntegerField(2, required=True)
+    rank = messages.IntegerField(3, required=True)
+    ranked_users = messages.IntegerField(4, required=True)
+
+
 class UserForms(messages.Message):
     """Form to return a list of all users
     """
     users = messages.MessageField(UserForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
+    more = messages.BooleanField(3)
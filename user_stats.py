@@ -0,0 +1,96 @@
+from protorpc import messages
+from google.appengine.ext import ndb
+
+import scoring
+from scorecard import CategoryType
+
+"""
+user_stats.py - Running statistics of each user's finished games.
+
+A UserStats entity, with the same id as its User, keeps counts and sums
+that are updated in the transaction that records each finished game, so
+averages and rates are read with a single get instead of a scan of the
+user's games.
+"""
+
+
+class UserStats(ndb.Model):
+    """Totals over a User's finished games"""
+    games_played = ndb.IntegerProperty(default=0, indexed=False)
+    total_score = ndb.IntegerProperty(default=0, indexed=False)
+    upper_bonuses = ndb.IntegerProperty(default=0, indexed=False)
+    # Every YAHTZEE rolled and scored, in the YAHTZEE box or as a bonus.
+    yahtzees = ndb.IntegerProperty(default=0, indexed=False)
+    # Per category, in the order of scoring.CATEGORY_NAMES: the sum of the
+    # scores entered and the number of games it scored more than 0 in.
+    category_totals = ndb.IntegerProperty(repeated=True, indexed=False)
+    category_hits = ndb.IntegerProperty(repeated=True, indexed=False)
+
+    @classmethod
+    def key_for(cls, user_key):
+        return ndb.Key(cls, user_key.id())
+
+    @classmethod
+    def for_user(cls, user_key, stats=None):
+        """Returns stats, or new empty UserStats for user_key if it is
+        None."""
+        if stats is None:
+            stats = cls(key=cls.key_for(user_key))
+        if not stats.category_totals:
+            stats.category_totals = [0] * scoring.NUM_CATEGORIES
+            stats.category_hits = [0] * scoring.NUM_CATEGORIES
+        return stats
+
+    def add_game(self, game):
+        """Adds the scores of a finished Game."""
+        scores = game.category_scores
+        self.games_played += 1
+        self.total_score += game.final_score
+        if game.bonus_points:
+            self.upper_bonuses += 1
+        self.yahtzees += game.yahtzee_bonus_count
+        if scores.get(scoring.YAHTZEE) == 50:
+            self.yahtzees += 1
+        for c in range(scoring.NUM_CATEGORIES):
+            score = max(scores.get(c), 0)
+            self.category_totals[c] += score
+            if score:
+                self.category_hits[c] += 1
+
+    def _average(self, total):
+        return float(total) / self.games_played if self.games_played else 0.0
+
+    def to_form(self, user):
+        return UserStatsForm(
+            user_name=user.name,
+            games_played=self.games_played,
+            high_score=user.high_score,
+            average_score=self._average(self.total_score),
+            upper_bonus_rate=self._average(self.upper_bonuses),
+            yahtzees=self.yahtzees,
+            categories=[
+                CategoryStatsForm(
+                    category=CategoryType(c + 1),
+                    average_score=self._average(self.category_totals[c]),
+                    scored_rate=self._average(self.category_hits[c]))
+                for c in range(scoring.NUM_CATEGORIES)])
+
+
+# Forms
+
+class CategoryStatsForm(messages.Message):
+    """CategoryStatsForm for a user's results in one category"""
+    category = messages.EnumField(CategoryType, 1, required=True)
+    average_score = messages.FloatField(2, required=True)
+    scored_rate = messages.FloatField(3, required=True)
+
+
+class UserStatsForm(messages.Message):
+    """UserStatsForm for the statistics of a user's finished games"""
+    user_name = messages.StringField(1, required=True)
+    games_played = messages.IntegerField(2, required=True)
+    high_score = messages.IntegerField(3, required=True)
+    average_score = messages.FloatField(4, required=True)
+    upper_bonus_rate = messages.FloatField(5, required=True)
+    yahtzees = messages.IntegerField(6, required=True)
+    categories = messages.MessageField(CategoryStatsForm, 7, repeated=True)
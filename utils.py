@@ -1,25 +1,184 @@
+import cPickle as pickle
 import logging
+import threading
+import time
+from collections import OrderedDict
+
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
+from protorpc import messages
 import endpoints
 
-"""utils.py - File for collecting general utility functions."""
+import storage
 
+"""utils.py - File for collecting general utility functions.
 
-def get_by_urlsafe(urlsafe, model):
-    """Returns an ndb.Model entity that the urlsafe key points to. Checks
-        that the type of entity returned is of the correct kind. Raises an
-        error if the key String is malformed or the entity is of the incorrect
-        kind
+get_by_urlsafe reads Games and Users through a two-tier cache: an LRU in
+this process whose entries expire after LOCAL_TTL seconds, in front of
+memcache, which every instance shares.  Both tiers are updated whenever a
+Game or User is stored through storage.py and cleared when one is deleted,
+so an instance only sees another instance's write up to LOCAL_TTL seconds
+late.  Entities are kept pickled, so each request gets its own copy.
+Endpoints that change an entity read it with get_for_update instead, from
+the datastore in their transaction, so they never change a stale copy.
+"""
+
+CACHED_KINDS = ('Game', 'User')
+LOCAL_CACHE_SIZE = 1000
+LOCAL_TTL = 5
+SHARED_TTL = 10 * 60
+_SHARED_PREFIX = 'entity:'
+
+
+class CacheStatsForm(messages.Message):
+    """CacheStatsForm for the entity cache counters of one instance"""
+    local_hits = messages.IntegerField(1, required=True)
+    shared_hits = messages.IntegerField(2, required=True)
+    misses = messages.IntegerField(3, required=True)
+    updates = messages.IntegerField(4, required=True)
+    invalidations = messages.IntegerField(5, required=True)
+    local_entries = messages.IntegerField(6, required=True)
+
+
+class EntityCache(object):
+    """Read-through cache of entities by urlsafe key.
     Args:
-        urlsafe: A urlsafe key string
-        model: The expected entity kind
-    Returns:
-        The entity that the urlsafe Key string points to or None if no entity
-        exists.
-    Raises:
-        ValueError:"""
+        shared: A memcache client for the shared tier, or None for none.
+    """
+
+    def __init__(self, shared=None, size=LOCAL_CACHE_SIZE, ttl=LOCAL_TTL,
+                 shared_ttl=SHARED_TTL):
+        self.shared = shared
+        self.size = size
+        self.ttl = ttl
+        self.shared_ttl = shared_ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.stats = dict.fromkeys(['local_hits', 'shared_hits', 'misses',
+                                    'updates', 'invalidations'], 0)
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _get_local(self, urlsafe):
+        with self._lock:
+            entry = self._entries.pop(urlsafe, None)
+            if entry is None or entry[0] < time.time():
+                return None
+            self._entries[urlsafe] = entry
+            return entry[1]
+
+    def _set_local(self, urlsafe, data):
+        with self._lock:
+            self._entries.pop(urlsafe, None)
+            self._entries[urlsafe] = (time.time() + self.ttl, data)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def get_local(self, urlsafe):
+        """Returns the entity with the urlsafe key if it is in this
+        instance's tier, otherwise None."""
+        data = self._get_local(urlsafe)
+        if data is None:
+            return None
+        self._count('local_hits')
+        return pickle.loads(data)
+
+    def get(self, key):
+        """Returns the entity for key from the cache or the datastore, or
+        None if it does not exist."""
+        if key.kind() not in CACHED_KINDS:
+            return storage.get(key)
+        urlsafe = key.urlsafe()
+        entity = self.get_local(urlsafe)
+        if entity is not None:
+            return entity
+
+        data = self.shared.get(_SHARED_PREFIX + urlsafe) if self.shared \
+            else None
+        if data is not None:
+            self._count('shared_hits')
+            self._set_local(urlsafe, data)
+            return pickle.loads(data)
+
+        self._count('misses')
+        entity = storage.get(key)
+        if entity is not None:
+            data = self._cache_locally([entity])
+            if self.shared:
+                # add, not set, so a write made since the read wins.
+                self.shared.add_multi(data, time=self.shared_ttl,
+                                      key_prefix=_SHARED_PREFIX)
+        return entity
+
+    def _cache_locally(self, entities):
+        """Stores the cached kinds of entities in this instance's tier and
+        returns their pickles by urlsafe key."""
+        cached = {}
+        for entity in entities:
+            if entity.key is not None and entity.key.kind() in CACHED_KINDS:
+                data = pickle.dumps(entity, pickle.HIGHEST_PROTOCOL)
+                self._set_local(entity.key.urlsafe(), data)
+                cached[entity.key.urlsafe()] = data
+        return cached
+
+    def update(self, entities, deleted_keys):
+        """Stores entities in both tiers and removes deleted_keys; called by
+        storage.py after every write."""
+        cached = self._cache_locally(entities)
+        deleted = [key.urlsafe() for key in deleted_keys
+                   if key.kind() in CACHED_KINDS]
+        with self._lock:
+            for urlsafe in deleted:
+                self._entries.pop(urlsafe, None)
+            self.stats['updates'] += len(cached)
+            self.stats['invalidations'] += len(deleted)
+
+        if self.shared:
+            if cached:
+                self.shared.set_multi(cached, time=self.shared_ttl,
+                                      key_prefix=_SHARED_PREFIX)
+            if deleted:
+                self.shared.delete_multi(deleted, key_prefix=_SHARED_PREFIX)
+
+    def clear(self):
+        """Empties this instance's tier."""
+        with self._lock:
+            self._entries.clear()
+
+    def to_form(self):
+        with self._lock:
+            return CacheStatsForm(local_entries=len(self._entries),
+                                  **self.stats)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_entity_cache():
+    """Returns this instance's EntityCache.  The shared tier is only used
+    with the datastore, since the other storage backends are local to the
+    process anyway."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            repository = storage.get_repository()
+            _cache = EntityCache(
+                memcache if isinstance(repository, storage.NdbRepository)
+                else None)
+    return _cache
+
+
+storage.add_write_listener(
+    lambda entities, deleted_keys: get_entity_cache().update(entities,
+                                                             deleted_keys))
+
+
+def _key_from_urlsafe(urlsafe):
     try:
-        key = ndb.Key(urlsafe=urlsafe)
+        return ndb.Key(urlsafe=urlsafe)
     except TypeError:
         raise endpoints.BadRequestException('Invalid Key')
     except Exception, e:
@@ -28,9 +187,49 @@ def get_by_urlsafe(urlsafe, model):
         else:
             raise
 
-    entity = key.get()
+
+def _check_kind(entity, model):
     if not entity:
         return None
     if not isinstance(entity, model):
         raise ValueError('Incorrect Kind')
     return entity
+
+
+def get_by_urlsafe(urlsafe, model):
+    """Returns an ndb.Model entity that the urlsafe key points to. Checks
+        that the type of entity returned is of the correct kind. Raises an
+        error if the key String is malformed or the entity is of the incorrect
+        kind
+    Args:
+        urlsafe: A urlsafe key string
+        model: The expected entity kind
+    Returns:
+        The entity that the urlsafe Key string points to or None if no entity
+        exists.
+    Raises:
+        ValueError:"""
+    cache = get_entity_cache()
+    # Entries are kept under the urlsafe form of their keys, so a hit skips
+    # parsing the key.
+    entity = cache.get_local(urlsafe)
+    if entity is None:
+        entity = cache.get(_key_from_urlsafe(urlsafe))
+    return _check_kind(entity, model)
+
+
+def get_for_update(urlsafe, model):
+    """Returns the entity that the urlsafe key points to like get_by_urlsafe,
+        but read from the datastore rather than the entity cache, whose local
+        tier may be LOCAL_TTL seconds behind.  For endpoints that change the
+        entity; call it inside storage.run_in_transaction so that the write
+        is made to the version that was read.
+    Args:
+        urlsafe: A urlsafe key string
+        model: The expected entity kind
+    Returns:
+        The entity that the urlsafe Key string points to or None if no entity
+        exists.
+    Raises:
+        ValueError:"""
+    return _check_kind(storage.get(_key_from_urlsafe(urlsafe)), model)
@@ -1,3 +1,5 @@
+import datetime
+
 import endpoints
 import jinja2
 
@@ -11,16 +13,23 @@ from google.appengine.api import taskqueue
 
 from google.appengine.ext import ndb
 
-from user import User, UserForm, UserForms
+from user import User, UserForm, UserForms, UserRankForm
+from user_stats import UserStats, UserStatsForm
 from game import Game, GameForm, GameForms, StringMessage, \
-    GameHistoryForm, Score, ScoreForms, HighScoresForm, ScoreRollForm
+    GameHistoryForm, Score, ScoreForms, HighScoresForm, ScoreRollForm, \
+    CategorySuggestionForm, KeepersForm, KeepersSuggestionForm
 
 from turn import Turn, TurnForm
 
-from scorecard import CategoryType, Scorecard, \
-    ScorecardForm, ScoreTurnForm
+from scorecard import CategoryType, Scorecard, ScorecardForm, ScoreTurnForm
+
+from utils import get_by_urlsafe, get_for_update
 
-from utils import get_by_urlsafe
+import game_history
+import leaderboard
+import metrics
+import solver
+import storage
 
 """
 yahtzee.py - Create and configure the game API.
@@ -59,8 +68,19 @@ NEW_TURN_REQUEST = endpoints.ResourceContainer(
 GET_GAME_REQUEST = endpoints.ResourceContainer(
     urlsafe_game_key=messages.StringField(1))
 
+GAME_HISTORY_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    from_turn=messages.IntegerField(2),
+    to_turn=messages.IntegerField(3))
+
 USER_GAMES_REQUEST = endpoints.ResourceContainer(
-    user_name=messages.StringField(1))
+    user_name=messages.StringField(1),
+    page_size=messages.IntegerField(2),
+    cursor=messages.StringField(3))
+
+PAGE_REQUEST = endpoints.ResourceContainer(
+    page_size=messages.IntegerField(1),
+    cursor=messages.StringField(2))
 
 SCORE_ROLL_REQUEST = endpoints.ResourceContainer(
   ScoreRollForm,
@@ -77,11 +97,29 @@ ROLL_AGAIN_REQUEST = endpoints.ResourceContainer(
 SCORECARD_REQUEST = endpoints.ResourceContainer(
     urlsafe_game_key=messages.StringField(1),)
 
+USER_RANK_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1))
+
+LEADERBOARD_REQUEST = endpoints.ResourceContainer(
+    period=messages.EnumField(leaderboard.Period, 1,
+                              default=leaderboard.Period.DAILY),
+    date=messages.StringField(2))
+
+USER_STATS_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1))
+
 HIGH_SCORES_REQUEST = endpoints.ResourceContainer(
     number_of_results=messages.IntegerField(1))
 
+SUGGEST_KEEPERS_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    number_of_results=messages.IntegerField(2))
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
 TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'templates')
 JINJA_ENVIRONMENT = jinja2.Environment(
     loader=jinja2.FileSystemLoader(TEMPLATE_DIR),
@@ -93,6 +131,20 @@ def render_str(template, **params):
     return t.render(params)
 
 
+def query_page(model, request, filters=()):
+    """Returns the page of a query asked for by the page_size and cursor
+    of a request, with the cursor of the next page and whether there are
+    more results."""
+    page_size = min(request.page_size or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+    if page_size < 1:
+        raise endpoints.BadRequestException('page_size must be positive.')
+    try:
+        return storage.query_page(model, filters, page_size=page_size,
+                                  cursor=request.cursor)
+    except ValueError:
+        raise endpoints.BadRequestException('Invalid cursor.')
+
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 # @endpoints.api( name='yahtzee',
@@ -116,14 +168,16 @@ class YahtzeeApi(remote.Service):
                       path='users',
                       name='create_user',
                       http_method='POST')
+    @metrics.instrumented
     def create_user(self, request):
         """Creates a User. Requires a unique username.
         """
-        if User.query(User.name == request.user_name).get():
+        if not request.user_name:
+            raise endpoints.BadRequestException('A user_name is required!')
+        user = User.create(request.user_name, request.email)
+        if not user:
             raise endpoints.ConflictException(
                 'A User with that name already exists!')
-        user = User(name=request.user_name, email=request.email)
-        user.put()
         # return StringMessage(message='User {} created!'.format(
         #         request.user_name))
         return user.to_form()
@@ -138,6 +192,7 @@ class YahtzeeApi(remote.Service):
                       path='users/{urlsafe_user_key}',
                       name='get_user',
                       http_method='GET')
+    @metrics.instrumented
     def get_user(self, request):
         """Returns the user
         """
@@ -157,16 +212,17 @@ class YahtzeeApi(remote.Service):
                       path='users/{user_name}',
                       name='update_user',
                       http_method='PUT')
+    @metrics.instrumented
     def update_user(self, request):
         """Updates the User.
         """
-        user = User.query(User.name == request.user_name).get()
+        user = User.get_by_name(request.user_name)
+        if user:
+            try:
+                user = user.update(request.email, request.high_score)
+            except ValueError as e:
+                raise endpoints.BadRequestException(str(e))
         if user:
-            if request.email:
-                user.email = request.email
-            if request.high_score:
-                user.high_score = request.high_score
-            user.put()
             return user.to_form()
         else:
             raise endpoints.NotFoundException('User not found!')
@@ -181,13 +237,13 @@ class YahtzeeApi(remote.Service):
                       path='users/{user_name}',
                       name='delete_user',
                       http_method='DELETE')
+    @metrics.instrumented
     def delete_user(self, request):
         """Deletes the User.
         """
-        print request.user_name
-        user = User.query(User.name == request.user_name).get()
+        user = User.get_by_name(request.user_name)
         if user:
-            user.key.delete()
+            user.remove()
             return StringMessage(message='User {} deleted.'.format(request.user_name))
         else:
             raise endpoints.NotFoundException('User not found!')
@@ -197,25 +253,76 @@ class YahtzeeApi(remote.Service):
                       path='users/rankings',
                       name='get_user_rankings',
                       http_method='GET')
+    @metrics.instrumented
     def get_user_rankings(self, request):
-        """Return all Users ranked by their high score."""
-        users = User.query().fetch()
-        users = sorted(users, key=lambda x: x.high_score, reverse=True)
+        """Return the top Users ranked by their high score."""
+        keys = [user_key for score, user_key in leaderboard.top()]
+        users = [user for user in storage.get_multi(keys) if user]
         return UserForms(users=[user.to_form() for user in users])
 
+    """
+        GET /users/{user_name}/rank
+
+        Retrieves the position of a user on the leaderboard
+    """
+    @endpoints.method(request_message=USER_RANK_REQUEST,
+                      response_message=UserRankForm,
+                      path='users/{user_name}/rank',
+                      name='get_user_rank',
+                      http_method='GET')
+    @metrics.instrumented
+    def get_user_rank(self, request):
+        """Returns the rank of the User's high score among all Users."""
+        user = User.get_by_name(request.user_name)
+        if not user:
+            raise endpoints.NotFoundException('User not found!')
+        rank, ranked_users = leaderboard.rank(user.high_score)
+        return UserRankForm(user_name=user.name,
+                            high_score=user.high_score,
+                            rank=rank,
+                            ranked_users=ranked_users)
+
+    """
+        GET /users/{user_name}/stats
+
+        Retrieves the statistics of a user's finished games
+    """
+    @endpoints.method(request_message=USER_STATS_REQUEST,
+                      response_message=UserStatsForm,
+                      path='users/{user_name}/stats',
+                      name='get_user_stats',
+                      http_method='GET')
+    @metrics.instrumented
+    def get_user_stats(self, request):
+        """Returns the User's average score, bonus rate, YAHTZEE count and
+        per-category averages."""
+        user = User.get_by_name(request.user_name)
+        if not user:
+            raise endpoints.NotFoundException('User not found!')
+        stats = UserStats.for_user(user.key,
+                                   storage.get(UserStats.key_for(user.key)))
+        return stats.to_form(user)
+
     """
         GET /users
 
         Retrieves a list of users
     """
 
-    @endpoints.method(response_message=UserForms,
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=UserForms,
                       path='users',
                       name='get_users',
                       http_method='GET')
+    @metrics.instrumented
     def get_users(self, request):
-        """Returns all Users in the database."""
-        return UserForms(users=[user.to_form() for user in User.query()])
+        """Returns a page of the Users in the database.
+        Optional Parameters: page_size (default 20, at most 100) and the
+        cursor returned with the previous page."""
+        users, next_cursor, more = query_page(User, request)
+        return UserForms(users=[user.to_form() for user in users],
+                         next_cursor=next_cursor,
+                         more=more)
 
     """
         POST /games
@@ -228,10 +335,10 @@ class YahtzeeApi(remote.Service):
                       path='games',
                       name='create_game',
                       http_method='POST')
+    @metrics.instrumented
     def create_game(self, request):
         """Creates new game."""
-        print 'new game requested for user ', request.user_name
-        user = User.query(User.name == request.user_name).get()
+        user = User.get_by_name(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                 'A User with that name does not exist!')
@@ -246,13 +353,20 @@ class YahtzeeApi(remote.Service):
         Retrieves a list of games
     """
 
-    @endpoints.method(response_message=GameForms,
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=GameForms,
                       path='games',
                       name='get_games',
                       http_method='GET')
+    @metrics.instrumented
     def get_games(self, request):
-        """Returns all Games in the database."""
-        return GameForms(games=[game.to_form() for game in Game.query()])
+        """Returns a page of the Games in the database.
+        Optional Parameters: page_size (default 20, at most 100) and the
+        cursor returned with the previous page."""
+        games, next_cursor, more = query_page(Game, request)
+        return GameForms(games=Game.to_forms(games),
+                         next_cursor=next_cursor,
+                         more=more)
 
 
     # Get a game
@@ -261,6 +375,7 @@ class YahtzeeApi(remote.Service):
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @metrics.instrumented
     def get_game(self, request):
         """Returns the current Game state."""
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
@@ -275,18 +390,22 @@ class YahtzeeApi(remote.Service):
                       path='user/games',
                       name='get_user_games',
                       http_method='GET')
+    @metrics.instrumented
     def get_user_games(self, request):
         """Returns the user's active games."""
 
         # Query for a user with this user name.
-        user = User.query(User.name == request.user_name).get()
+        user = User.get_by_name(request.user_name)
         if not user:
             message = ('User {} not found!').format(request.user_name)
             raise endpoints.NotFoundException(message)
-        # Query for all active games for this user.
-        games = Game.query(Game.user == user.key).filter(
-            Game.game_over == False)
-        return GameForms(games=[game.to_form() for game in games])
+        # Query for a page of the active games for this user.
+        games, next_cursor, more = query_page(
+            Game, request, [('user', '==', user.key),
+                            ('game_over', '==', False)])
+        return GameForms(games=Game.to_forms(games),
+                         next_cursor=next_cursor,
+                         more=more)
 
     # Cancel game
     @endpoints.method(request_message=GET_GAME_REQUEST,
@@ -294,17 +413,20 @@ class YahtzeeApi(remote.Service):
                       path='game/{urlsafe_game_key}',
                       name='cancel_game',
                       http_method='DELETE')
+    @metrics.instrumented
     def cancel_game(self, request):
         """Deletes an active game."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game and not game.game_over:
-            game.key.delete()
-            return StringMessage(message='Game with key: {} deleted.'.
-                                 format(request.urlsafe_game_key))
-        elif game and game.game_over:
-            raise endpoints.BadRequestException('Game is already over!')
-        else:
-            raise endpoints.NotFoundException('Game not found!')
+        def cancel():
+            game = get_for_update(request.urlsafe_game_key, Game)
+            if game and not game.game_over:
+                storage.delete(game.key)
+                return StringMessage(message='Game with key: {} deleted.'.
+                                     format(request.urlsafe_game_key))
+            elif game and game.game_over:
+                raise endpoints.BadRequestException('Game is already over!')
+            else:
+                raise endpoints.NotFoundException('Game not found!')
+        return storage.run_in_transaction(cancel)
 
     # Roll dice
     @endpoints.method(request_message=UPDATE_GAME_REQUEST,
@@ -312,17 +434,20 @@ class YahtzeeApi(remote.Service):
                       path='game/{urlsafe_game_key}/roll',
                       name='roll_dice',
                       http_method='POST')
+    @metrics.instrumented
     def roll_dice(self, request):
       """Rolls the dice in a new turn."""
-      game = get_by_urlsafe(request.urlsafe_game_key, Game)
-      if not game:
-          raise endpoints.NotFoundException('Game not found!')
-      if game.game_over:
-          raise endpoints.NotFoundException('Game is already over!')
-      if game.has_incomplete_turn:
-          raise endpoints.ConflictException('Cannot start a new turn until current turn is scored!')
+      def roll():
+        game = get_for_update(request.urlsafe_game_key, Game)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        if game.game_over:
+            raise endpoints.NotFoundException('Game is already over!')
+        if game.has_incomplete_turn:
+            raise endpoints.ConflictException('Cannot start a new turn until current turn is scored!')
 
-      return game.roll_dice()
+        return game.roll_dice()
+      return storage.run_in_transaction(roll)
 
     # Roll dice again.
     @endpoints.method(request_message=ROLL_AGAIN_REQUEST,
@@ -330,22 +455,25 @@ class YahtzeeApi(remote.Service):
                       path='game/{urlsafe_game_key}/reroll',
                       name='roll_again',
                       http_method='POST')
+    @metrics.instrumented
     def roll_again(self, request):
-      game = get_by_urlsafe(request.urlsafe_game_key, Game)
-      if not game:
-          raise endpoints.NotFoundException('Game not found!')
-      if game.game_over:
-          raise endpoints.NotFoundException('Game is already over!')
+      def roll():
+        game = get_for_update(request.urlsafe_game_key, Game)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        if game.game_over:
+            raise endpoints.NotFoundException('Game is already over!')
 
-      keepers = request.keepers
-      if len(keepers) != 5:
-        raise endpoints.ConflictException(
-          'Keepers array must have five elements (0 or 1).')
+        keepers = request.keepers
+        if len(keepers) != 5:
+          raise endpoints.ConflictException(
+            'Keepers array must have five elements (0 or 1).')
 
-      if game.roll_count == 3:
-        raise endpoints.ConflictException('Already rolled dice 3 times in this turn.')
+        if game.roll_count == 3:
+          raise endpoints.ConflictException('Already rolled dice 3 times in this turn.')
 
-      return game.roll_again(keepers)
+        return game.roll_again(keepers)
+      return storage.run_in_transaction(roll)
 
     # Score the current roll
     @endpoints.method(request_message=SCORE_ROLL_REQUEST,
@@ -353,20 +481,97 @@ class YahtzeeApi(remote.Service):
                       path='game/{urlsafe_game_key}/score',
                       name='score_roll',
                       http_method='POST')
+    @metrics.instrumented
     def score_roll(self, request):
+      def score():
+        game = get_for_update(request.urlsafe_game_key, Game)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+
+        if not game.has_incomplete_turn:
+            raise endpoints.ConflictException('Must roll the dice before scoring!')
+
+        category_type = request.category_type
+        if category_type is None:
+          message = ('Category {} not found!').format(category_type)
+          raise endpoints.ConflictException(message)
+        if game.category_scores.is_filled(category_type.number - 1):
+          message = ('{} category already contains a score.  Please select a different score category.').format(
+              str(category_type))
+          raise endpoints.ConflictException(message)
+
+        # Calculate the score based on the category selected.
+        return game.score_roll(category_type)
+      return storage.run_in_transaction(score)
+
+    # Suggest the best category for the current roll
+    @endpoints.method(request_message=GET_GAME_REQUEST,
+                      response_message=CategorySuggestionForm,
+                      path='game/{urlsafe_game_key}/suggest_category',
+                      name='suggest_category',
+                      http_method='GET')
+    @metrics.instrumented
+    def suggest_category(self, request):
+      """Returns the category that maximizes the expected final score
+      for the current dice."""
+      game = get_by_urlsafe(request.urlsafe_game_key, Game)
+      if not game:
+          raise endpoints.NotFoundException('Game not found!')
+      if game.game_over:
+          raise endpoints.NotFoundException('Game is already over!')
+      if not game.has_incomplete_turn:
+          raise endpoints.ConflictException('Must roll the dice before scoring!')
+
+      try:
+          state_values = solver.get_state_values()
+      except (EnvironmentError, ValueError):
+          raise endpoints.InternalServerErrorException(
+              'Strategy table is not available.')
+
+      state = solver.game_state(game.category_scores)
+      category, score, expected_value = state_values.best_category(
+          state, game.dice)
+      return CategorySuggestionForm(category_type=CategoryType(category + 1),
+                                    score=score,
+                                    expected_value=expected_value)
+
+    # Suggest which dice to keep for the next roll
+    @endpoints.method(request_message=SUGGEST_KEEPERS_REQUEST,
+                      response_message=KeepersSuggestionForm,
+                      path='game/{urlsafe_game_key}/suggest_keepers',
+                      name='suggest_keepers',
+                      http_method='GET')
+    @metrics.instrumented
+    def suggest_keepers(self, request):
+      """Returns the keepers for roll_again that maximize the expected final
+      score, followed by the other keepers ranked by expected final score.
+      Optional Parameter: number_of_results to limit the number of
+      alternatives returned."""
       game = get_by_urlsafe(request.urlsafe_game_key, Game)
       if not game:
           raise endpoints.NotFoundException('Game not found!')
+      if game.game_over:
+          raise endpoints.NotFoundException('Game is already over!')
+      if not game.has_incomplete_turn:
+          raise endpoints.ConflictException('Must roll the dice before choosing keepers!')
+      if game.roll_count == 3:
+          raise endpoints.ConflictException('Already rolled dice 3 times in this turn.')
 
-      category_type = request.category_type
-      print 'category_type:', category_type
-      print game.category_scores.keys()
-      if str(category_type) not in game.category_scores.keys():
-        message = ('Category {} not found!').format(category_type)
-        raise endpoints.ConflictException(message)
+      try:
+          state_values = solver.get_state_values()
+      except (EnvironmentError, ValueError):
+          raise endpoints.InternalServerErrorException(
+              'Strategy table is not available.')
 
-      # Calculate the score based on the category selected.
-      return game.score_roll(category_type)
+      state = solver.game_state(game.category_scores)
+      ranking = state_values.rank_keepers(state, game.dice,
+                                          3 - game.roll_count)
+      forms = [KeepersForm(keepers=keepers, expected_value=expected_value)
+               for keepers, expected_value in ranking]
+      alternatives = forms[1:]
+      if request.number_of_results:
+          alternatives = alternatives[:request.number_of_results]
+      return KeepersSuggestionForm(best=forms[0], alternatives=alternatives)
 
 
     # # Create a new Turn
@@ -443,6 +648,7 @@ class YahtzeeApi(remote.Service):
                       path='turn/{urlsafe_turn_key}/score',
                       name='score_turn',
                       http_method='POST')
+    @metrics.instrumented
     def score_turn(self, request):
         """
         Calculates the score for the Turn.
@@ -455,91 +661,90 @@ class YahtzeeApi(remote.Service):
         if not turn:
             raise endpoints.NotFoundException('Turn not found!')
 
-        if turn.is_complete:
-            message = ('Turn {} is already scored!').format(
-                request.urlsafe_turn_key)
-            raise endpoints.ConflictException(message)
-
-        # Get the game
-        game = turn.game.get()
-
-        # Get the score card for this game.
-        scorecard = Scorecard.query(Scorecard.game == game.key).get()
+        # Find the score card for this game here, since queries cannot run
+        # in the transaction.
+        scorecard_key = storage.first(Scorecard,
+                                      [('game', '==', turn.game)]).key
 
-        # Check that the category_type is one of the expected types.
-        category_type = request.category_type
-        print 'category_type:', category_type
-        print scorecard.category_scores.keys()
-        if str(category_type) not in scorecard.category_scores.keys():
-            message = ('Category {} not found!').format(category_type)
-            raise endpoints.ConflictException(message)
-
-
-        # Check if there is already a score entered for the selected category.
-        current_score = scorecard.category_scores[str(category_type)]
-
-        """The YAHTZEE category is the only category which can be scored more than once.
-           So check the category type and whether or not the category had already been scored.
-        """
-        if category_type is not 'YAHZTEE' and current_score > -1:
-            message = ('{} category already contains a score.  Please select a different score category.').format(
-                str(category_type))
-            raise endpoints.ConflictException(message)
+        def score():
+            # Read the turn, game and score card again in the transaction.
+            turn = get_for_update(request.urlsafe_turn_key, Turn)
+            if turn.is_complete:
+                message = ('Turn {} is already scored!').format(
+                    request.urlsafe_turn_key)
+                raise endpoints.ConflictException(message)
 
-        # Calculate the score for this turn based on the category selected.
-        score = scorecard.calculate_score_for_category(
-            turn.dice, category_type)
+            game, scorecard = storage.get_multi([turn.game, scorecard_key])
 
-        # Update the game history.
-        entry = (str(category_type), score)
-        # Add the entry to the game history.
-        game.history[turn.number].append(entry)
+            # Check that the category_type is one of the expected types.
+            category_type = request.category_type
+            if category_type is None:
+                message = ('Category {} not found!').format(category_type)
+                raise endpoints.ConflictException(message)
 
-        # Update the scorecard with the calculated score.
-        scorecard.category_scores[str(category_type)] = score
+            # Check if there is already a score entered for the selected category.
+            if scorecard.category_scores.is_filled(category_type.number - 1):
+                message = ('{} category already contains a score.  Please select a different score category.').format(
+                    str(category_type))
+                raise endpoints.ConflictException(message)
 
-        # Turn is now complete
-        game.has_incomplete_turn = False
-        turn.is_complete = True
-        turn.put()
+            # Calculate the score for this turn based on the category selected.
+            score = scorecard.calculate_score_for_category(
+                turn.dice, category_type)
 
-        # Save the updated scorecard values.
-        scorecard.put()
+            # Add the entry to the game history.
+            game.update_history(game_history.encode_score(
+                turn.number, category_type.number - 1, score))
 
-        # Check to see if the game is over.
-        game_over = scorecard.check_full()
-        print 'game_over = ', game_over
+            # Update the scorecard with the calculated score.
+            scorecard.category_scores.set(category_type.number - 1, score)
 
-        # If the game is now over, calculate the final score.
-        if game_over:
+            # Turn is now complete
+            game.has_incomplete_turn = False
+            turn.is_complete = True
 
-            final_score = scorecard.calculate_final_score()
-            print 'final score:', final_score
+            # Check to see if the game is over.
+            game_over = scorecard.check_full()
 
-            # End the game
-            game.game_over(final_score)
+            # If the game is now over, calculate the final score.
+            if game_over:
 
-        # Save the changes made to game
-        game.put()
+                final_score = scorecard.calculate_final_score()
 
+                # End the game, saving the turn, scorecard and game together.
+                game.final_score = final_score
+                game.end_game(final_score, [turn, scorecard])
+            else:
+                # Save the turn, scorecard and game together.
+                storage.commit([turn, scorecard, game])
 
-        return scorecard.to_form()
+            return scorecard.to_form()
+        return storage.run_in_transaction(score)
 
 
     # Get Game History
-    @endpoints.method(request_message=GET_GAME_REQUEST,
+    @endpoints.method(request_message=GAME_HISTORY_REQUEST,
                       response_message=GameHistoryForm,
                       path='game/{urlsafe_game_key}/history',
                       name='get_game_history',
                       http_method='GET'
                       )
+    @metrics.instrumented
     def get_game_history(self, request):
-        """Returns the roll and score history for each turn in a game."""
+        """Returns the rolls and score of each turn in a game.
+        Optional Parameters: from_turn and to_turn to return only the turns
+        in that range, inclusive."""
+        if request.from_turn is not None and request.to_turn is not None \
+                and request.from_turn > request.to_turn:
+            raise endpoints.BadRequestException(
+                'from_turn must not be after to_turn.')
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
         if not game:
             raise endpoints.NotFoundException('Game not found')
 
-        return GameHistoryForm(history=str(game.history))
+        return GameHistoryForm(
+            turns=game.history_forms(request.from_turn, request.to_turn),
+            turn_count=game.turn_count)
 
 
     # Get the scorecard for a game
@@ -548,13 +753,14 @@ class YahtzeeApi(remote.Service):
                       path='game/{urlsafe_game_key}/scorecard',
                       name='get_scorecard',
                       http_method='GET')
+    @metrics.instrumented
     def get_scorecard(self, request):
         """Returns the scorecard for a game."""
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
         if not game:
             raise endpoints.NotFoundException('Game not found!')
 
-        scorecard = Scorecard.query(Scorecard.game == game.key).get()
+        scorecard = storage.first(Scorecard, [('game', '==', game.key)])
         if not scorecard:
           raise endpoints.NotFoundException('Scorecard not found!')
 
@@ -565,17 +771,43 @@ class YahtzeeApi(remote.Service):
                       response_message=HighScoresForm,
                       path='scores',
                       http_method='GET')
+    @metrics.instrumented
     def get_high_scores(self, request):
         """
         Returns a list of high scores in descending order.
         Optional Parameter: number_of_results to limit the number of results returned.
         """
-        if request.number_of_results:
-          users = User.query().order(-User.high_score).fetch(request.number_of_results, offset=0)
+        entries = leaderboard.top(request.number_of_results or
+                                  leaderboard.TOP_K)
+        return HighScoresForm(scores=[score for score, user_key in entries])
+
+    # Get the leaderboard of a period
+    @endpoints.method(request_message=LEADERBOARD_REQUEST,
+                      response_message=leaderboard.LeaderboardForm,
+                      path='leaderboard',
+                      name='get_leaderboard',
+                      http_method='GET')
+    @metrics.instrumented
+    def get_leaderboard(self, request):
+        """
+        Returns the best games of a day, a week or of all time.
+        Optional Parameters: period (DAILY, WEEKLY or ALL_TIME, default
+        DAILY) and date (YYYY-MM-DD, default today) to pick the period.
+        """
+        if request.date:
+            try:
+                day = datetime.datetime.strptime(request.date,
+                                                 '%Y-%m-%d').date()
+            except ValueError:
+                raise endpoints.BadRequestException(
+                    'date must be in the form YYYY-MM-DD.')
         else:
-          users = User.query().order(-User.high_score).fetch()
-        # users = sorted(users, key=lambda x: x.high_score, reverse=True)
-        return HighScoresForm(scores=[user.high_score for user in users])
+            day = datetime.date.today()
+        bucket = leaderboard.top_scores(request.period, day)
+        if not bucket:
+            return leaderboard.LeaderboardForm(period=request.period,
+                                               date=str(day))
+        return bucket.to_form(request.period, day)
 
 # registers API
 api = endpoints.api_server([YahtzeeApi])